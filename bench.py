@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''Microbenchmarks of the wire protocol, the overlay and the group messaging.
+Messages are encoded and parsed in memory, sent over socket pairs and
+through the overlay with neighbours connected by socket pairs. The overlay
+engines and group connections are measured with peers on the loopback
+interface. The results are written as JSON, and can be compared with the
+file of an earlier run to spot regressions:
+
+    bench.py -o new.json --compare old.json
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import network
+import proto
+from bloom_filter import BloomFilter
+from fingerprint_set import FingerprintSet, to_hex
+from minhash import MinHashSignature
+from network.async_overlay import AsyncOverlay
+from network.group import GroupLeader
+from network.overlay import Overlay
+from network.peer import Peer
+from signalqueue import QueueSet
+
+SIZES = (100, 1000, 10000, 100000)  # songs per message
+NEIGHBOURS = (2, 8, 32)
+CONNECTIONS = (10, 100, 500)  # peers connected to the overlay engines
+ENGINES = {'threads': Overlay, 'asyncio': AsyncOverlay}
+PINGS = 1000  # round trips measured per engine
+GROUP_MEMBERS = (1, 8, 32)
+PLAYS = 200  # play commands measured per group size
+JOINERS = (8, 32, 128)  # members joining a group at the same time
+MIN_TIME = 0.2  # seconds each measurement runs at least
+REPEAT = 3  # measurements per benchmark, the best one is reported
+
+
+def measure(action):
+    '''Return the best time per call of action() in seconds.'''
+    best = None
+    for _ in range(REPEAT):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            action()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_TIME:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+
+def fingerprints(n):
+    return FingerprintSet(random.getrandbits(64) for _ in range(n))
+
+
+def messages(size, encoding):
+    '''Return realistic messages carrying the given number of songs, as they
+    are sent in the given encoding.'''
+    songs = fingerprints(size)
+    addrs = set('10.{}.{}.{}:5000'.format(i >> 16, (i >> 8) & 255, i & 255)
+                for i in range(min(size, 1000)))
+    if encoding == 'binary':
+        music, signature = BloomFilter.from_items(songs, 0.01), MinHashSignature(songs)
+    else:
+        # nodes from before binary frames get the exact music in pongs
+        music, signature = songs, None
+    return [
+        ('GroupMusic', proto.GroupMusic(songs, 1)),
+        ('Sample', proto.Sample(songs.sample(min(size, 1000)), signature)),
+        ('GroupPong', proto.GroupPong(uuid.uuid4(), '10.0.0.1:6000', music, signature)),
+        ('Pong', proto.Pong(str(uuid.uuid4()), addrs)),
+    ]
+
+
+class Drain(threading.Thread):
+    '''Reads and discards everything arriving on a socket.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+        threading.Thread.__init__(self, daemon=True)
+        self.start()
+
+    def run(self):
+        buffer = bytearray(65536)
+        while True:
+            try:
+                n = self.sock.recv_into(buffer)
+            except OSError:
+                return
+            if n == 0:
+                return
+            self.received += n
+
+
+class Feeder(threading.Thread):
+    '''Sends the same data on a socket over and over.'''
+
+    def __init__(self, sock, data):
+        self.sock = sock
+        self.data = data
+        threading.Thread.__init__(self, daemon=True)
+        self.start()
+
+    def run(self):
+        try:
+            while True:
+                self.sock.sendall(self.data)
+        except OSError:
+            return
+
+
+def bench_codec(results, sizes, encodings):
+    for size in sizes:
+        for encoding in encodings:
+            for name, message in messages(size, encoding):
+                frame = proto.encode(message, encoding)
+                key = dict(message=name, size=size, encoding=encoding, bytes=len(frame))
+                results.append(dict(key, benchmark='encode',
+                                    seconds=measure(lambda: proto.encode(message, encoding))))
+                # parse() takes pickled messages without the length prefix
+                data = frame if encoding == 'binary' else frame.partition(b'\n')[2]
+                results.append(dict(key, benchmark='parse',
+                                    seconds=measure(lambda: proto.parse(data))))
+
+                # receive frames over a socket pair, fed by another thread
+                a, b = socket.socketpair()
+                batch = max(1, 65536 // len(frame))
+                Feeder(a, frame * batch)
+                reader = proto.FrameReader(b)
+                results.append(dict(key, benchmark='receive',
+                                    seconds=measure(reader.read)))
+                a.close()
+                b.close()
+
+
+def bench_peer_send(results, sizes, encodings):
+    for size in sizes:
+        for encoding in encodings:
+            for name, message in messages(size, encoding):
+                a, b = socket.socketpair()
+                Drain(b)
+                peer = Peer(('127.0.0.1', 1), None, reuse_socket=a)
+                peer.encoding = encoding
+                results.append(dict(benchmark='peer-send', message=name, size=size,
+                                    encoding=encoding,
+                                    bytes=len(proto.encode(message, encoding)),
+                                    seconds=measure(lambda: peer.send(message))))
+                # wait for the writer to send what is queued
+                peer.disconnect()
+                peer.writer.join()
+                a.close()
+                b.close()
+
+
+def make_overlay(n_neighbours, encoding):
+    '''Return an overlay that is not listening, with neighbours connected by
+    socket pairs, and the inbox queue of its first neighbour.'''
+    overlay = Overlay.__new__(Overlay)
+    overlay.logger = logging.getLogger('overlay')
+    overlay.state = {
+        'neighbours': [],
+        'joining': None,
+        'pings': dict(),
+        'group': None,
+        'group_pings': dict(),
+        'group_candidates': dict()
+    }
+    overlay.queues = QueueSet()
+    overlay.queue_to_peer = dict()
+    sockets = []
+    for i in range(n_neighbours):
+        a, b = socket.socketpair()
+        Drain(b)
+        q = overlay.queues.New()
+        peer = Peer(('10.0.0.{}'.format(i), 5000), q, reuse_socket=a)
+        peer.encoding = encoding
+        overlay.state['neighbours'].append(peer)
+        overlay.queue_to_peer[q] = peer
+        sockets += [a, b]
+    return overlay, overlay.state['neighbours'][0].inbox, sockets
+
+
+def bench_fanout(results, neighbours, encodings):
+    for n in neighbours:
+        for encoding in encodings:
+            overlay, inbox, sockets = make_overlay(n, encoding)
+            peers = overlay.state['neighbours']
+
+            def group_ping():
+                overlay._peer_event(inbox, proto.GroupPing(uuid.uuid4()))
+
+            def ping_pong():
+                # a ping from the first neighbour is forwarded to all others,
+                # their pongs are collected and answered with one pong
+                ping_id = str(uuid.uuid4())
+                overlay._peer_event(inbox, proto.Ping(ping_id, 3))
+                for p in peers[1:]:
+                    overlay._peer_event(
+                        p.inbox, proto.Pong(ping_id, {'10.1.0.{}:5000'.format(i)
+                                                      for i in range(8)}))
+
+            key = dict(neighbours=n, encoding=encoding)
+            results.append(dict(key, benchmark='fanout-group-ping', seconds=measure(group_ping)))
+            if n > 1:
+                results.append(dict(key, benchmark='fanout-ping-pong', seconds=measure(ping_pong)))
+            for p in peers:
+                p.disconnect()
+                p.writer.join()
+            for s in sockets:
+                s.close()
+
+
+def _rss():
+    '''Return the resident memory of this process in bytes, if known.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _read_until(sock, reader, cls):
+    # readers without a socket have no receive buffer of their own, which
+    # would count as memory of the engine
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError('overlay closed the connection')
+        for message in reader.feed(data):
+            if isinstance(message, cls):
+                return message
+
+
+def engine_child(engine, connections):
+    '''Connect the given number of peers to an overlay running in this
+    process and measure it. Prints the result as JSON.'''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    network.set_address('127.0.0.1', port)
+
+    memory = _rss()
+    overlay = ENGINES[engine](None)
+    overlay.start()
+    clients = []
+    for i in range(connections):
+        sock = socket.create_connection(('127.0.0.1', port))
+        reader = proto.FrameReader()
+        # become a neighbour, so the connection is kept open
+        sock.sendall(proto.encode(proto.Hello(str(20000 + i))) +
+                     proto.encode(proto.Neighbour(force=True)))
+        _read_until(sock, reader, proto.Neighbour)
+        clients.append((sock, reader))
+    threads = threading.active_count()
+    if memory is not None:
+        memory = _rss() - memory
+
+    latencies = []
+    for i in range(PINGS):
+        sock, reader = clients[i % len(clients)]
+        start = time.perf_counter()
+        sock.sendall(proto.encode(proto.Ping(str(uuid.uuid4()), 0)))
+        _read_until(sock, reader, proto.Pong)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(json.dumps(dict(benchmark='engine', engine=engine, connections=connections,
+                          threads=threads, memory=memory,
+                          seconds=latencies[len(latencies) // 2],
+                          latency_p99=latencies[len(latencies) * 99 // 100])))
+
+
+class Members:
+    '''Group members listening on the loopback interface, counting the
+    messages they receive, and the members that were told they joined.'''
+
+    def __init__(self, n):
+        self.received = 0
+        self.joined = set()
+        self.changed = threading.Condition()
+        self.sockets = []
+        for _ in range(n):
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(16)
+            self.sockets.append(sock)
+        self.addresses = ['127.0.0.1:{}'.format(s.getsockname()[1]) for s in self.sockets]
+        for (sock, address) in zip(self.sockets, self.addresses):
+            threading.Thread(target=self.accept, args=(sock, address), daemon=True).start()
+
+    def accept(self, sock, address):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.receive, args=(conn, address), daemon=True).start()
+
+    def receive(self, conn, address):
+        reader = proto.FrameReader(conn)
+        with conn:
+            while True:
+                try:
+                    message = reader.read()
+                except OSError:
+                    return
+                if message is None:
+                    return
+                with self.changed:
+                    self.received += 1
+                    if isinstance(message, proto.GroupInfo) and address in message.peers:
+                        self.joined.add(address)
+                    self.changed.notify_all()
+
+    def wait(self, received=0, joined=0):
+        with self.changed:
+            while self.received < received or len(self.joined) < joined:
+                self.changed.wait()
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def make_leader(addresses=(), encoding='pickle'):
+    '''Return a group leader without music, listening on a free port, with
+    the given members.'''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    network.set_address('127.0.0.1', network.get_port())
+    network.set_group_port(port)
+    leader = GroupLeader(FingerprintSet())
+    leader.peers.update(addresses)
+    leader.encodings.update((a, encoding) for a in addresses)
+    return leader
+
+
+def bench_group_play(results, sizes, encodings):
+    '''Measure the time from a play command of the leader until the last
+    member has received it.'''
+    for n in sizes:
+        for encoding in encodings:
+            members = Members(n)
+            leader = make_leader(members.addresses, encoding)
+            latencies = []
+            for i in range(PLAYS):
+                start = time.perf_counter()
+                leader.send_all(proto.GroupPlaylist.play(0))
+                members.wait((i + 1) * n)
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            results.append(dict(benchmark='group-play', members=n, encoding=encoding,
+                                seconds=latencies[len(latencies) // 2],
+                                latency_p99=latencies[len(latencies) * 99 // 100]))
+            leader.stop()
+            members.close()
+
+
+def bench_group_join(results, sizes, encodings):
+    '''Measure the time until the given number of members joining a group at
+    the same time have all received a group info listing them.'''
+    for n in sizes:
+        for encoding in encodings:
+            members = Members(n)
+            leader = make_leader()
+            start = time.perf_counter()
+            connections = []
+            for address in members.addresses:
+                sock = socket.create_connection(('127.0.0.1', network.get_group_port()))
+                port = network.parse_address(address)[1]
+                codecs = proto.ANNOUNCED_CODECS if encoding == 'binary' else ('pickle',)
+                sock.sendall(proto.encode(proto.GroupJoin(port, codecs), encoding))
+                connections.append(sock)
+            members.wait(joined=n)
+            seconds = time.perf_counter() - start
+            results.append(dict(benchmark='group-join', members=n, encoding=encoding,
+                                seconds=seconds, per_second=n / seconds))
+            for sock in connections:
+                sock.close()
+            leader.stop()
+            members.close()
+
+
+def bench_engines(results, connections, encodings):
+    '''Compare the overlay engines, each in a fresh process. Peers announce
+    all encodings, so the overlay uses the binary one.'''
+    for n in connections:
+        for engine in sorted(ENGINES):
+            output = subprocess.check_output([sys.executable, __file__, '--engine-child',
+                                              engine, str(n)], universal_newlines=True)
+            results.append(json.loads(output.splitlines()[-1]))
+
+
+def _key(result):
+    return tuple(sorted((k, v) for (k, v) in result.items()
+                        if k not in ('seconds', 'per_second', 'bytes', 'threads', 'memory',
+                                     'latency_p99')))
+
+
+def compare(results, old_path):
+    '''Print the results that changed compared to an earlier run.'''
+    with open(old_path) as f:
+        old = dict((_key(r), r) for r in json.load(f)['results'])
+    for result in results:
+        before = old.get(_key(result))
+        if before is None:
+            continue
+        change = result['seconds'] / before['seconds']
+        label = ' '.join('{}={}'.format(k, v) for (k, v) in _key(result))
+        print('{:6.2f}x  {}'.format(change, label))
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the wire protocol')
+    parser.add_argument('-o', '--output', default='bench_output.json')
+    parser.add_argument('-c', '--compare', metavar='OLD_OUTPUT')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('-n', '--neighbours', type=int, nargs='+', default=NEIGHBOURS)
+    parser.add_argument('-e', '--encodings', nargs='+', default=proto.CODECS)
+    parser.add_argument('-t', '--min-time', type=float, default=MIN_TIME)
+    parser.add_argument('-p', '--connections', type=int, nargs='+', default=CONNECTIONS)
+    parser.add_argument('-g', '--group-members', type=int, nargs='+', default=GROUP_MEMBERS)
+    parser.add_argument('-j', '--joiners', type=int, nargs='+', default=JOINERS)
+    parser.add_argument('--engine-child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(0)
+    MIN_TIME = args.min_time
+    # there is no library to take the md5 hex digests of pickled messages
+    # from, make up ones of the same length
+    proto.legacy.set_legacy_hashes(lambda fingerprints: [to_hex(h) * 2 for h in fingerprints])
+
+    if args.engine_child:
+        engine_child(args.engine_child[0], int(args.engine_child[1]))
+        sys.exit(0)
+
+    results = []
+    for name, bench, params in (('codec', bench_codec, args.sizes),
+                                ('peer send', bench_peer_send, args.sizes),
+                                ('fan-out', bench_fanout, args.neighbours),
+                                ('group play', bench_group_play, args.group_members),
+                                ('group join', bench_group_join, args.joiners),
+                                ('overlay engine', bench_engines, args.connections)):
+        print('running {} benchmarks'.format(name), file=sys.stderr)
+        bench(results, params, args.encodings)
+    for result in results:
+        result.setdefault('per_second', 1 / result['seconds'])
+
+    with open(args.output, 'w') as f:
+        json.dump({'revision': _revision(), 'python': platform.python_version(),
+                   'time': time.time(), 'results': results}, f, indent=1, sort_keys=True)
+    print('results written to {}'.format(args.output), file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
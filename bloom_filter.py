@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import math
+
+_mask = 0xffffffff
+MAX_HASHES = 32  # hash functions a filter may use, limits the cost of a lookup
+
+
+class BloomFilter(object):
+    '''A compact summary of a set of song hashes. Membership tests can give
+    false positives at about the configured rate, but no false negatives.'''
+
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError('invalid error rate {}'.format(error_rate))
+        capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = min(MAX_HASHES, max(1, int(round(self.size / capacity * math.log(2)))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.check()
+
+    def check(self):
+        '''Raise ValueError unless the parameters of the filter fit together,
+        e.g. for a filter received from another node.'''
+        if self.size <= 0 or len(self.bits) != (self.size + 7) // 8:
+            raise ValueError('invalid filter size {}'.format(self.size))
+        if not 1 <= self.hashes <= MAX_HASHES:
+            raise ValueError('invalid number of hash functions {}'.format(self.hashes))
+        # more items than bits would make the filter match almost anything
+        if not 0 <= self.count <= self.size:
+            raise ValueError('invalid number of items {}'.format(self.count))
+        if not 0 < self.error_rate < 1:
+            raise ValueError('invalid error rate {}'.format(self.error_rate))
+
+    @staticmethod
+    def from_items(items, error_rate=0.01):
+        items = list(items)
+        bloom = BloomFilter(len(items), error_rate)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _indices(self, item):
+        # song hashes are uniformly distributed already, so two 32 bit parts
+        # of them serve as the base hashes for double hashing
+        h1 = item & _mask
+        h2 = ((item >> 32) & _mask) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for i in self._indices(item):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indices(item))
+
+    def __len__(self):
+        '''Return the number of items added.'''
+        return self.count
+
+    def estimate_common(self, items):
+        '''Estimate how many of the given (distinct) items were added, taking
+        false positives into account.'''
+        items = list(items)
+        hits = sum(1 for item in items if item in self)
+        common = (hits - self.error_rate * len(items)) / (1 - self.error_rate)
+        return min(max(common, 0.0), float(self.count))
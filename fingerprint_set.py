@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from array import array
+from bisect import bisect_left
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def to_hex(fingerprint):
+    '''Format a fingerprint for display.'''
+    return '{:016x}'.format(fingerprint)
+
+
+def from_hex(text):
+    '''Return the fingerprint of a song hash in hex, as formatted by to_hex or
+    the md5 hex digest nodes without fingerprints identify songs by.'''
+    return int(text[:16], 16)
+
+
+class FingerprintSet(object):
+    '''An immutable set of 64 bit song fingerprints, kept as a sorted array.
+    Intersections are vectorized with numpy if it is available.'''
+
+    def __init__(self, items=()):
+        if isinstance(items, FingerprintSet):
+            self.array = items.array
+        else:
+            self.array = array('Q', sorted(set(items)))
+
+    @staticmethod
+    def _from_sorted(values):
+        result = FingerprintSet()
+        result.array = values
+        return result
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __contains__(self, fingerprint):
+        a = self.array
+        i = bisect_left(a, fingerprint)
+        return i < len(a) and a[i] == fingerprint
+
+    def __eq__(self, other):
+        return isinstance(other, FingerprintSet) and self.array == other.array
+
+    def __repr__(self):
+        return 'FingerprintSet({})'.format(len(self))
+
+    def _other_array(self, other):
+        if isinstance(other, FingerprintSet):
+            return other.array
+        return FingerprintSet(other).array
+
+    def __and__(self, other):
+        a, b = self.array, self._other_array(other)
+        if numpy is not None:
+            common = numpy.intersect1d(numpy.frombuffer(a, numpy.uint64),
+                                       numpy.frombuffer(b, numpy.uint64),
+                                       assume_unique=True)
+            return FingerprintSet._from_sorted(array('Q', common.tobytes()))
+        if len(a) > len(b):
+            a, b = b, a
+        other = set(b)
+        return FingerprintSet._from_sorted(array('Q', [x for x in a if x in other]))
+
+    __rand__ = __and__
+
+    def __sub__(self, other):
+        b = self._other_array(other)
+        if numpy is not None:
+            rest = numpy.setdiff1d(numpy.frombuffer(self.array, numpy.uint64),
+                                   numpy.frombuffer(b, numpy.uint64),
+                                   assume_unique=True)
+            return FingerprintSet._from_sorted(array('Q', rest.tobytes()))
+        remove = set(b)
+        return FingerprintSet._from_sorted(array('Q', [x for x in self.array
+                                                       if x not in remove]))
+
+    def count_common(self, other):
+        '''Return the number of fingerprints in both sets.'''
+        return len(self & other)
+
+    def sample(self, size):
+        '''Return a random subset of at most size fingerprints.'''
+        a = self.array
+        # sorting the positions keeps the result sorted, without comparing
+        # the (large) fingerprints themselves
+        positions = sorted(random.sample(range(len(a)), min(size, len(a))))
+        return FingerprintSet._from_sorted(array('Q', [a[i] for i in positions]))
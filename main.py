@@ -9,7 +9,9 @@ except ImportError:
     pass
 
 import network
+import network.peer
 from network.overlay import Overlay
+from network.async_overlay import AsyncOverlay
 import mpd
 
 
@@ -34,6 +36,10 @@ if __name__ == '__main__':
     parser.add_argument('overlay_port')
     parser.add_argument('group_port')
     parser.add_argument('-c', '--connect', nargs='+', dest='remotes')
+    parser.add_argument('-e', '--engine', choices=('threads', 'asyncio'), default='threads',
+                        help='run every overlay connection in a thread, or all in one event loop')
+    parser.add_argument('-f', '--flush-delay', type=float, default=0.0,
+                        help='milliseconds to collect outgoing messages before sending them')
 
     args = parser.parse_args()
 
@@ -46,8 +52,12 @@ if __name__ == '__main__':
 
     network.set_address(args.address, args.overlay_port)
     network.set_group_port(args.group_port)
+    network.peer.set_flush_delay(args.flush_delay / 1000)
 
-    the_overlay = Overlay(args.remotes)
+    if args.engine == 'asyncio':
+        the_overlay = AsyncOverlay(args.remotes)
+    else:
+        the_overlay = Overlay(args.remotes)
     the_overlay.start()
 
     try:
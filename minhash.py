@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+
+SIGNATURE_SIZE = 128
+
+
+class MinHashSignature(object):
+    '''A bottom-k MinHash signature of a set of song hashes: the k smallest
+    hash values of the set. Two signatures give an estimate of the Jaccard
+    similarity of their sets in O(k).'''
+
+    def __init__(self, items, size=SIGNATURE_SIZE):
+        self.size = size
+        # song fingerprints are uniformly distributed already, so they serve
+        # as the values of a single hash function
+        self.values = heapq.nsmallest(size, set(items))
+
+    def __len__(self):
+        return len(self.values)
+
+    def jaccard(self, other):
+        '''Estimate the Jaccard similarity of the two underlying sets.'''
+        k = min(self.size, other.size)
+        ours, theirs = set(self.values), set(other.values)
+        # the k smallest values of the union are a sample of the union, the
+        # share of them in both sets estimates the similarity
+        union = heapq.nsmallest(k, ours | theirs)
+        if not union:
+            return 0.0
+        return sum(1 for v in union if v in ours and v in theirs) / len(union)
@@ -1,15 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from subprocess import Popen
+from hashlib import md5
+from subprocess import Popen, TimeoutExpired
 from tempfile import TemporaryDirectory
 import logging
 import os
-import socket
+import shutil
+import time
 
-from mpd import daemon, playback
+from mpd import daemon, music, watcher
 
 _mpd_dir = None
 _mpd_proc = None
+_mpd_db = None
+_cached_db = None
+
+CONNECT_DELAY = 0.01  # initial delay between tries to connect to a new mpd
+CONNECT_DELAY_MAX = 0.5
+
+
+def _cache_dir(music_dir):
+    '''Return the directory keeping data about music_dir between runs.'''
+    root = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    key = md5(music_dir.encode()).hexdigest()
+    path = os.path.join(root, 'e2e', key)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _connect(mpd_socket, proc):
+    '''Wait until mpd accepts connections and return a connection.'''
+    delay = CONNECT_DELAY
+    while True:
+        try:
+            return daemon.Connection(mpd_socket)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if proc.poll() is not None:
+                raise RuntimeError('mpd exited with status {}'.format(proc.returncode))
+            time.sleep(delay)
+            delay = min(2 * delay, CONNECT_DELAY_MAX)
+
+
+def _save_db():
+    '''Keep mpd's database in the cache directory for the next run.'''
+    if os.path.getsize(_mpd_db) == 0:
+        return
+    tmp_path = '{}.{}'.format(_cached_db, os.getpid())
+    shutil.copyfile(_mpd_db, tmp_path)
+    os.replace(tmp_path, _cached_db)
 
 
 def run(music_dir):
@@ -18,12 +56,24 @@ def run(music_dir):
         raise FileNotFoundError(music_dir)
 
     logger = logging.getLogger('mpd')
+    start = time.monotonic()
+    cache_dir = _cache_dir(music_dir)
+    music.set_music_dir(music_dir)
+    music.set_index_file(os.path.join(cache_dir, 'songs'))
+
     global _mpd_dir
     _mpd_dir = TemporaryDirectory(prefix='e2e-mpd.')
     mpd_dir = _mpd_dir.name
-    # create temporary config for mpd
-    mpd_db = os.path.join(mpd_dir, 'db')
-    os.mknod(mpd_db)
+    # create temporary config for mpd, starting from the database of the last
+    # run, so mpd does not need to rescan the whole music directory
+    global _mpd_db, _cached_db
+    mpd_db = _mpd_db = os.path.join(mpd_dir, 'db')
+    _cached_db = os.path.join(cache_dir, 'db')
+    if os.path.exists(_cached_db):
+        shutil.copyfile(_cached_db, mpd_db)
+        logger.debug('reusing database {}'.format(_cached_db))
+    else:
+        os.mknod(mpd_db)
 
     mpd_socket = os.path.join(mpd_dir, 'socket')
     os.mknod(mpd_socket)
@@ -43,24 +93,35 @@ def run(music_dir):
     _mpd_proc = Popen(['mpd', '--no-daemon', mpd_conf])
     daemon.set_socket(mpd_socket)
 
-    # wait for mpd to start
-    while True:
-        try:
-            playback.get_status()
-            break
-        except (ConnectionRefusedError, FileNotFoundError):
-            pass
-    # wait for music database
-    while 'db_update' not in daemon.get_dict("stats"):
-        try:
-            daemon.get_query("idle database", timeout=0.5)
-        except socket.timeout:
-            pass
+    conn = _connect(mpd_socket, _mpd_proc)
+    try:
+        stats = next(daemon.split_dicts(conn.query('stats')))
+        if 'db_update' in stats:
+            # the reused database is complete, pick up changes in background
+            conn.query('update')
+        else:
+            # mpd reports database changes on this connection since the stats
+            while 'db_update' not in stats:
+                conn.query('idle database')
+                stats = next(daemon.split_dicts(conn.query('stats')))
+    finally:
+        conn.close()
 
-    logger.info('ready')
+    watcher.start(mpd_socket)
+    logger.info('ready after {:.2f}s'.format(time.monotonic() - start))
 
 
 def kill():
-    _mpd_proc.kill()
-    _mpd_proc.wait()
+    watcher.stop()
+    # let mpd exit cleanly, so its database file is complete
+    _mpd_proc.terminate()
+    try:
+        _mpd_proc.wait(timeout=5)
+    except TimeoutExpired:
+        _mpd_proc.kill()
+        _mpd_proc.wait()
+    try:
+        _save_db()
+    except OSError as e:
+        logging.getLogger('mpd').warning('cannot save mpd database ({})'.format(e))
     _mpd_dir.cleanup()
@@ -1,47 +1,272 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import select
 import socket
+import threading
 
 
 _mpd_socket = None
+_pool = None
+
+
+class MPDError(Exception):
+    '''Raised when mpd answers a streamed query with an error.'''
+
+
+class Connection(object):
+    '''A single client connection to the mpd socket. Replies are read into a
+    reusable buffer and split into lines without copying the whole reply.'''
+    chunk_size = 65536
+
+    def __init__(self, path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.buffer = bytearray()
+        self.pos = 0  # start of the unread data in buffer
+        self.chunk = memoryview(bytearray(Connection.chunk_size))
+        self.sent = False  # whether a query was sent since the last reset
+        try:
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+            greeting = self.read_line()
+        except OSError:
+            self.sock.close()
+            raise
+        if not greeting.startswith('OK MPD'):
+            self.close()
+            raise ConnectionError('unexpected greeting from mpd: {}'.format(greeting))
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def send(self, lines):
+        self.sock.sendall(b''.join(bytes(l + '\n', 'utf8') for l in lines))
+        self.sent = True
+
+    def is_closed(self):
+        '''Return whether mpd closed the connection while it was idle. mpd
+        sends nothing unasked, so an idle connection that is readable was
+        closed.'''
+        poll = select.poll()
+        poll.register(self.sock, select.POLLIN)
+        return bool(poll.poll(0))
+
+    def _fill(self):
+        n = self.sock.recv_into(self.chunk)
+        if n == 0:
+            raise ConnectionResetError('mpd closed the connection')
+        # drop the consumed part only when refilling, so each byte of a reply
+        # is moved at most once
+        del self.buffer[:self.pos]
+        self.pos = 0
+        self.buffer += self.chunk[:n]
+
+    def read_line(self):
+        while True:
+            end = self.buffer.find(b'\n', self.pos)
+            if end >= 0:
+                break
+            self._fill()
+        with memoryview(self.buffer) as view:
+            line = str(view[self.pos:end], 'utf8')
+        self.pos = end + 1
+        return line
+
+    def read_reply(self, end='OK'):
+        '''Read the lines of one reply up to the given terminator. Returns
+        None if mpd answered with an error.'''
+        lines = []
+        while True:
+            line = self.read_line()
+            if line == end:
+                return lines
+            elif line.startswith('ACK'):
+                return None
+            lines.append(line)
+
+    def query(self, text):
+        self.send([text])
+        return self.read_reply()
+
+    def command_list(self, texts):
+        '''Send all queries in one command list and split the replies. Returns
+        a list with the lines of each reply, or None for the query that failed
+        and all queries after it, as mpd aborts the list on the first error.'''
+        self.send(['command_list_ok_begin'] + list(texts) + ['command_list_end'])
+        results = []
+        for _ in texts:
+            lines = self.read_reply(end='list_OK')
+            if lines is None:
+                break
+            results.append(lines)
+        else:
+            self.read_reply()
+        return results + [None] * (len(texts) - len(results))
+
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionPool(object):
+    '''A thread-safe pool of mpd connections that are kept open between
+    queries.'''
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if conn.is_closed():
+                conn.close()
+                continue
+            conn.sent = False
+            return conn, True
+        return Connection(self.path), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def run(self, action, timeout=None):
+        '''Run action(connection) on a pooled connection. A connection that
+        was dropped by mpd (e.g. because of its connection_timeout) is replaced
+        and the action is retried, but only if the query could not be sent:
+        once mpd may have received it, it must not run twice.'''
+        while True:
+            conn, reused = self.acquire()
+            try:
+                conn.settimeout(timeout)
+                result = action(conn)
+            except ConnectionError:
+                conn.close()
+                if reused and not conn.sent:
+                    continue
+                raise
+            except Exception:
+                # the connection is in an unknown state (e.g. timed out while
+                # waiting for an idle event), do not reuse it
+                conn.close()
+                raise
+            self.release(conn)
+            return result
+
+    def stream(self, text, timeout=None):
+        '''Send a query on a pooled connection and yield the lines of the reply
+        as they are read. The connection is only returned to the pool if the
+        reply was read completely.'''
+        while True:
+            conn, reused = self.acquire()
+            try:
+                conn.settimeout(timeout)
+                conn.send([text])
+                line = conn.read_line()
+            except ConnectionError:
+                conn.close()
+                if reused and not conn.sent:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        complete = False
+        try:
+            while line != 'OK':
+                if line.startswith('ACK'):
+                    complete = True
+                    raise MPDError(line)
+                yield line
+                line = conn.read_line()
+            complete = True
+        finally:
+            if complete:
+                self.release(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+def quote(s):
+    '''Quote an argument for an mpd query.'''
+    return '"{}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
 
 
 def set_socket(mpd_socket):
-    global _mpd_socket
+    global _mpd_socket, _pool
+    if _pool is not None:
+        _pool.close()
     _mpd_socket = mpd_socket
+    _pool = ConnectionPool(mpd_socket)
 
 
 def get_query(text, timeout=None):
-    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-        s.settimeout(timeout)
-        s.connect(_mpd_socket)
-        data = s.recv(32)
-        s.sendall(bytes(text + '\n', 'utf8'))
-        response = b''
-
-        data = s.recv(4096)
-        if data.startswith(b'ACK'):
-            return None
-        while True:
-            response = response + data
-            if data[-4:] == b'\nOK\n' or data == b'OK\n':
-                break
-            data = s.recv(4096)
-        return str(response, 'utf8').splitlines()[:-1]
+    return _pool.run(lambda conn: conn.query(text), timeout)
 
 
-def get_dicts(query):
-    response = get_query(query)
-    new_token = response[0].split(': ', 1)[0]
-    dicts = []
-    for r in response:
-        tag, value = r.split(': ', 1)
-        if tag == new_token:
-            d = dict([(tag, value)])
-            dicts.append(d)
+def iter_query(text, timeout=None):
+    '''Like get_query, but yield the lines of the reply while they arrive.
+    Raises MPDError if mpd answers with an error.'''
+    return _pool.stream(text, timeout)
+
+
+def get_queries(texts, timeout=None):
+    '''Send several queries in command lists and return a list of replies
+    (lists of lines), with None for each query that failed.'''
+    texts = list(texts)
+    results = []
+    while len(results) < len(texts):
+        batch = texts[len(results):]
+        replies = _pool.run(lambda conn: conn.command_list(batch), timeout)
+        if None in replies:
+            # keep the replies up to the failed query and resend the rest
+            failed = replies.index(None)
+            results.extend(replies[:failed + 1])
+        else:
+            results.extend(replies)
+    return results
+
+
+def split_dicts(lines, keys=None):
+    '''Turn reply lines into dicts, one at a time. A new dict is started by
+    each of the given tags, or by the first tag of the reply.'''
+    d = None
+    for line in lines:
+        tag, _, value = line.partition(': ')
+        if keys is None:
+            keys = (tag,)
+        if tag in keys:
+            if d is not None:
+                yield d
+            d = {tag: value}
         else:
             d[tag] = value
-    return dicts
+    if d is not None:
+        yield d
+
+
+def iter_dicts(query, keys=None):
+    '''Like get_dicts, but yield the dicts while the reply is read, so large
+    replies can be processed in constant memory.'''
+    return split_dicts(iter_query(query), keys)
+
+
+def get_dicts(query):
+    return list(iter_dicts(query))
 
 
 def get_dict(query):
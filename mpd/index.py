@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import os
+import pickle
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+# preferred names of cover images, best first
+COVER_NAMES = ('cover', 'folder', 'front', 'albumart', 'album')
+
+
+def find_cover(path):
+    '''Return the name of the best cover image in a directory, or None.'''
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return None
+    images = [n for n in names if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS]
+    if not images:
+        return None
+
+    def rank(name):
+        stem = os.path.splitext(name)[0].lower()
+        try:
+            return (COVER_NAMES.index(stem), name)
+        except ValueError:
+            return (len(COVER_NAMES), name)
+    return min(images, key=rank)
+
+
+class SongIndex(object):
+    '''Song hashes by file, together with the modification time of each file
+    and the mpd database update they were taken from. The index can be saved
+    to disk, so only changed files need to be hashed again after a restart.
+    It also keeps the cover image of every directory containing songs.'''
+    format_version = 4
+
+    def __init__(self, path=None):
+        self.path = path
+        self.db_update = None
+        self.entries = dict()  # file -> (mtime, hash, song)
+        self.covers = dict()  # directory -> (mtime, image name or None)
+
+    def load(self):
+        '''Load the index from its file. A missing or unreadable file leaves
+        the index empty.'''
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logging.getLogger('music').warning('cannot read song index {} ({})'
+                                               .format(self.path, e))
+            return
+        if data[0] == SongIndex.format_version:
+            _, self.db_update, self.entries, self.covers = data
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = '{}.{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            data = (SongIndex.format_version, self.db_update, self.entries,
+                    self.covers)
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def files(self):
+        return set(self.entries.keys())
+
+    def get_mtime(self, path):
+        try:
+            return self.entries[path][0]
+        except KeyError:
+            return None
+
+    def add(self, song, song_hash):
+        self.entries[song.path] = (getattr(song, 'mtime', None), song_hash, song)
+
+    def remove(self, path):
+        del self.entries[path]
+
+    def get_hashes(self):
+        '''Return a dict mapping song hashes to songs.'''
+        return dict((h, s) for (_, h, s) in self.entries.values())
+
+    def update_covers(self, root):
+        '''Look for cover images in the directories whose modification time
+        changed, and forget directories without songs.'''
+        directories = set(os.path.dirname(path) for path in self.entries)
+        for d in set(self.covers) - directories:
+            del self.covers[d]
+        for d in directories:
+            try:
+                mtime = os.stat(os.path.join(root, d)).st_mtime
+            except OSError:
+                mtime = None
+            if d not in self.covers or self.covers[d][0] != mtime:
+                self.covers[d] = (mtime, find_cover(os.path.join(root, d)))
+
+    def get_cover(self, directory):
+        try:
+            return self.covers[directory][1]
+        except KeyError:
+            return None
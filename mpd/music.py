@@ -1,37 +1,192 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import logging
 import os
-from random import sample
+import sys
+import time
 from hashlib import md5
 
-from mpd.daemon import get_dicts
+from bloom_filter import BloomFilter
+from fingerprint_set import FingerprintSet
+from mpd.daemon import MPDError, get_dicts, get_queries, iter_query, quote, split_dicts
+from mpd.index import SongIndex
+from mpd.search import SearchIndex
+from mpd.watcher import Cache
+from minhash import MinHashSignature
 
 _hashes = None
-_last_uodate = None
+_fingerprints = None
+_index = SongIndex()
+_search = None
+_signature = None
+_legacy = None  # fingerprint -> md5 hex digest of the song
+_music_dir = None
+_last_scan = None
+_stats = Cache(lambda: get_dicts('stats')[0], ('database',))
 
+SCAN_WINDOW = 5000  # songs per query when scanning with find windows
+PROGRESS_STEP = 10000  # songs between progress reports of a scan
 
-def get_songs():
-    try:
-        files = (f['file'] for f in get_dicts('list file'))
-        return [Song(get_dicts('lsinfo "{}"'.format(f))[0]) for f in files]
-    except IndexError:
-        return []
+# keys starting a new entry in lsinfo-like replies
+_entry_keys = ('file', 'directory', 'playlist')
+
+
+def _iter_song_dicts(lines):
+    '''Split a stream of lsinfo-like reply lines into dicts, one per song.
+    Directory and playlist entries are skipped.'''
+    return (d for d in split_dicts(lines, _entry_keys) if 'file' in d)
+
+
+def _iter_windows(window):
+    start = 0
+    while True:
+        count = 0
+        query = 'find modified-since "0" window {}:{}'.format(start, start + window)
+        for d in _iter_song_dicts(iter_query(query)):
+            count += 1
+            yield d
+        if count < window:
+            return
+        start += window
+
+
+def log_progress(songs, seconds):
+    '''Log the progress of a library scan, see get_songs.'''
+    logging.getLogger('music').info('scanned {} songs in {:.1f}s ({:.0f} songs/s)'.format(
+        songs, seconds, songs / seconds if seconds > 0 else 0.0))
+
+
+def get_songs(progress=log_progress, window=None):
+    '''Scan the whole library in a single pass. The library is streamed with
+    listallinfo, or in find windows of the given size, which is also the
+    fallback if the reply is too large for mpd's output buffer. progress is
+    called with the number of songs and the seconds since the start every
+    PROGRESS_STEP songs, by default this is logged.'''
+    global _last_scan
+    logger = logging.getLogger('music')
+    start = time.monotonic()
+
+    def scan(dicts):
+        songs = []
+        for d in dicts:
+            songs.append(Song(d))
+            if progress is not None and len(songs) % PROGRESS_STEP == 0:
+                progress(len(songs), time.monotonic() - start)
+        return songs
+
+    if window is None:
+        try:
+            songs = scan(_iter_song_dicts(iter_query('listallinfo')))
+        except (MPDError, ConnectionError) as e:
+            # mpd drops the client without an error if the reply does not fit
+            # its output buffer, the windows are queried on another connection
+            logger.warning('listallinfo failed ({}), scanning in windows'.format(e))
+            window = SCAN_WINDOW
+    if window is not None:
+        songs = scan(_iter_windows(window))
+
+    elapsed = time.monotonic() - start
+    _last_scan = {
+        'songs': len(songs),
+        'seconds': elapsed,
+        'songs_per_second': len(songs) / elapsed if elapsed > 0 else 0.0
+    }
+    logger.info('scanned {songs} songs in {seconds:.2f}s ({songs_per_second:.0f} songs/s)'
+                .format(**_last_scan))
+    return songs
+
+
+def get_scan_stats():
+    '''Return the size, duration and rate of the last library scan.'''
+    return _last_scan
+
+
+def song_hash(song):
+    '''Return the 64 bit fingerprint identifying a song across libraries.'''
+    return int.from_bytes(md5(bytes(song)).digest()[:8], 'big')
+
+
+def set_index_file(path):
+    '''Keep the song index in the given file, loading what is already there.'''
+    global _hashes, _fingerprints, _index
+    _index = SongIndex(path)
+    _index.load()
+    _hashes = None
+    _fingerprints = None
+
+
+def set_music_dir(path):
+    '''Set the music directory of mpd, to find cover images without asking
+    mpd for its configuration.'''
+    global _music_dir
+    _music_dir = path
+
+
+def get_music_dir():
+    global _music_dir
+    if _music_dir is None:
+        _music_dir = get_dicts('config')[0]['music_directory']
+    return _music_dir
+
+
+def _update_index(index):
+    '''Bring the index up to date with the files mpd has changed since the
+    database update the index was taken from.'''
+    logger = logging.getLogger('music')
+    files = set(line.split(': ', 1)[1] for line in iter_query('list file'))
+    removed = index.files() - files
+    for path in removed:
+        index.remove(path)
+
+    query = 'find modified-since {}'.format(quote(index.db_update))
+    changed = 0
+    for d in _iter_song_dicts(iter_query(query)):
+        song = Song(d)
+        if index.get_mtime(song.path) != song.mtime:
+            index.add(song, song_hash(song))
+            changed += 1
+
+    # files new to mpd can have an older modification time
+    added = sorted(files - index.files())
+    for reply in get_queries('lsinfo {}'.format(quote(path)) for path in added):
+        for d in _iter_song_dicts(reply or []):
+            song = Song(d)
+            index.add(song, song_hash(song))
+
+    logger.info('updated song index: {} removed, {} changed, {} added'
+                .format(len(removed), changed, len(added)))
 
 
 def _update_hashes():
-    global _hashes
-    global _last_update
-    last_update = get_dicts('stats')[0]['db_update']
-    if _hashes is None or last_update != _last_update:
-        _hashes = dict((md5(bytes(s)).hexdigest(), s) for s in get_songs())
-        _last_update = last_update
+    global _hashes, _fingerprints, _search, _signature, _legacy
+    last_update = _stats.get()['db_update']
+    if _hashes is not None and last_update == _index.db_update:
+        return
+
+    if last_update != _index.db_update:
+        if _index.db_update is None:
+            for song in get_songs():
+                _index.add(song, song_hash(song))
+        else:
+            _update_index(_index)
+        _index.update_covers(get_music_dir())
+        _index.db_update = last_update
+        try:
+            _index.save()
+        except OSError as e:
+            logging.getLogger('music').warning('cannot save song index ({})'.format(e))
+    _hashes = _index.get_hashes()
+    _fingerprints = FingerprintSet(_hashes.keys())
+    _search = None
+    _signature = None
+    _legacy = None
 
 
 def get_hashes():
-    global _hashes
+    '''Return the fingerprints of our songs as a FingerprintSet.'''
     _update_hashes()
-    return set(_hashes.keys())
+    return _fingerprints
 
 
 def get_song(song_hash):
@@ -40,31 +195,86 @@ def get_song(song_hash):
     return _hashes[song_hash]
 
 
-def search_songs(title):
-    return [Song(s) for s in get_dicts('search Title "{}"'.format(title))]
+def search_hashes(query):
+    '''Return the hashes of the songs whose title, artist, album or album
+    artist contain words starting with each term of the query.'''
+    global _search
+    _update_hashes()
+    search = _search
+    if search is None:
+        search = _search = SearchIndex(_hashes)
+    return search.search(query)
+
+
+def search_songs(query):
+    songs = get_songs_for(search_hashes(query))
+    return sorted(songs, key=lambda s: (s.artist, s.title))
+
+
+def get_songs_for(song_hashes):
+    '''Return the songs for many hashes, checking for updates only once.'''
+    _update_hashes()
+    hashes = _hashes
+    return [hashes[h] for h in song_hashes]
 
 
 def get_image(song):
-    root = get_dicts("config")[0]['music_directory']
-    path = os.path.join(root, song.path)
-    path = os.path.dirname(path)
-    for f in os.listdir(path):
-        if os.path.splitext(f)[1] in [".jpg", ".png", ".gif"]:
-            return os.path.join(path, f)
-    return None
+    '''Return the path of the cover image for a song, or None. Covers are found
+    when the library is indexed, so this only looks up the index.'''
+    _update_hashes()
+    directory = os.path.dirname(song.path)
+    cover = _index.get_cover(directory)
+    if cover is None:
+        return None
+    return os.path.join(get_music_dir(), directory, cover)
 
 
 def get_sample(size=100):
-    return sample(get_hashes(), size)
+    return get_hashes().sample(size)
+
+
+def get_signature():
+    '''Return the MinHash signature of our music.'''
+    global _signature
+    _update_hashes()
+    signature = _signature
+    if signature is None:
+        signature = _signature = MinHashSignature(_fingerprints)
+    return signature
+
+
+def get_legacy_hashes(fingerprints):
+    '''Return the md5 hex digests nodes without fingerprints identify the
+    given songs by, in the same order. Songs we do not have are left out.'''
+    global _legacy
+    _update_hashes()
+    legacy = _legacy
+    if legacy is None:
+        legacy = _legacy = dict((h, md5(bytes(s)).hexdigest()) for (h, s) in _hashes.items())
+    return [legacy[h] for h in fingerprints if h in legacy]
+
+
+def check_signature(signature):
+    '''Estimate the Jaccard similarity of our music and the music with the
+    given MinHash signature.'''
+    return get_signature().jaccard(signature)
 
 
 def check_sample(to_check):
+    '''Return the percentage of the given songs that we have. to_check is a
+    collection of song hashes or a BloomFilter summarising them.'''
     if len(to_check) == 0:
         return 0
-    return int(len(set(to_check) & get_hashes()) / len(to_check) * 100)
+    if isinstance(to_check, BloomFilter):
+        common = to_check.estimate_common(get_hashes())
+    else:
+        common = get_hashes().count_common(to_check)
+    return int(common / len(to_check) * 100)
 
 
 class Song(object):
+    __slots__ = ('artist', 'title', 'albumartist', 'album', 'date', 'disc',
+                 'track', 'time', 'mtime', 'path')
     mpd_keys = {
         'Artist': 'artist',
         'Title': 'title',
@@ -74,13 +284,18 @@ class Song(object):
         'Disc': 'disc',
         'Track': 'track',
         'Time': 'time',
+        'Last-Modified': 'mtime',
         'file': 'path'
     }
+    # tags repeated by many songs share one string object
+    interned_keys = frozenset(('Artist', 'AlbumArtist', 'Album', 'Date', 'Disc'))
 
     def __init__(self, mpd_dict):
         for k, v in mpd_dict.items():
             if k in Song.mpd_keys:
-                self.__setattr__(Song.mpd_keys[k], v)
+                if k in Song.interned_keys:
+                    v = sys.intern(v)
+                setattr(self, Song.mpd_keys[k], v)
         self.time = int(self.time)
 
     def __bytes__(self):
@@ -92,4 +307,5 @@ class Song(object):
         return b'_'.join(c.encode() for c in components)
 
     def __repr__(self):
-        return 'Song' + repr(self.__dict__)
+        return 'Song' + repr(dict((k, getattr(self, k)) for k in Song.__slots__
+                                  if hasattr(self, k)))
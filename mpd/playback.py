@@ -1,69 +1,100 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import copy
+import time
 
 from mpd.music import Song
 from mpd.daemon import get_dicts, get_query
+from mpd.watcher import Cache, invalidate
 
 
-def get_status():
+def _fetch_status():
     return Status(get_dicts('status')[0])
 
 
-def get_currentsong():
+def _fetch_currentsong():
     try:
         return Song(get_dicts('currentsong')[0])
     except IndexError:
         return None
 
 
+_status = Cache(_fetch_status, ('player', 'playlist', 'options', 'mixer', 'database'))
+_currentsong = Cache(_fetch_currentsong, ('player', 'playlist'))
+
+
+def _command(query):
+    get_query(query)
+    invalidate('player', 'options')
+
+
+def get_status():
+    status = _status.get()
+    if status.state == 'play':
+        # mpd does not report the progress of the playing song
+        status = copy.copy(status)
+        status.advance(time.monotonic() - status.created)
+    return status
+
+
+def get_currentsong():
+    return _currentsong.get()
+
+
 def play(index=0):
-    get_query('play {}'.format(index))
+    _command('play {}'.format(index))
 
 
 def pause_toggle():
     state = get_status().state
     if state == 'play':
-        get_query('pause 1')
+        _command('pause 1')
     elif state == 'pause':
-        get_query('pause 0')
+        _command('pause 0')
     elif state == 'stop':
-        get_query('play')
+        _command('play')
 
 
 def stop():
-    get_query('stop')
+    _command('stop')
 
 
 def next():
-    get_query('next')
+    _command('next')
 
 
 def previous():
-    get_query('previous')
+    _command('previous')
 
 
 def repeat_toggle():
     if get_status().repeat:
-        get_query('repeat 0')
+        _command('repeat 0')
     else:
-        get_query('repeat 1')
+        _command('repeat 1')
 
 
 def random_toggle():
     if get_status().random:
-        get_query('random 0')
+        _command('random 0')
     else:
-        get_query('random 1')
+        _command('random 1')
 
 
 def single_toggle():
     if get_status().single:
-        get_query('single 0')
+        _command('single 0')
     else:
-        get_query('single 1')
+        _command('single 1')
 
 
 class Status(object):
+    __slots__ = ('audio', 'bitrate', 'consume', 'duration', 'elapsed', 'error',
+                 'lastloadedplaylist', 'mixrampdb', 'mixrampdelay', 'nextsong',
+                 'nextsongid', 'partition', 'playlist', 'playlistlength',
+                 'random', 'repeat', 'single', 'song', 'songid', 'state',
+                 'time', 'updating_db', 'volume', 'xfade', 'created')
+    mpd_keys = frozenset(__slots__)
     mpd_converters = {
         'bitrate': int,
         'consume': lambda x: x == '1',
@@ -83,9 +114,21 @@ class Status(object):
 
     def __init__(self, mpd_dict):
         for k, v in mpd_dict.items():
+            if k not in Status.mpd_keys:
+                # ignore keys of newer mpd versions
+                continue
             if k in Status.mpd_converters:
                 v = Status.mpd_converters[k](v)
-            self.__setattr__(k, v)
+            setattr(self, k, v)
 
         if 'time' in mpd_dict:
             self.time, self.duration = (int(x) for x in mpd_dict['time'].split(':'))
+        self.created = time.monotonic()
+
+    def advance(self, seconds):
+        '''Move the position in the current song forward by some seconds.'''
+        if hasattr(self, 'elapsed'):
+            self.elapsed += seconds
+            self.time = int(self.elapsed)
+            if hasattr(self, 'duration'):
+                self.time = min(self.time, self.duration)
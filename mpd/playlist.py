@@ -1,33 +1,95 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 
-from mpd.music import Song
-from mpd.daemon import get_dicts, get_query
+from mpd.music import Song, get_music_dir
+from mpd.daemon import get_dicts, get_queries, get_query, quote
+from mpd.watcher import Cache, invalidate
+
+
+def _fetch():
+    return [Song(s) for s in get_dicts('playlistinfo')]
+
+
+_playlist = Cache(_fetch, ('playlist',))
 
 
 def get():
-    try:
-        return [Song(s) for s in get_dicts('playlistinfo')]
-    except IndexError:
-        return []
+    return list(_playlist.get())
+
+
+def _command(query):
+    get_query(query)
+    invalidate('playlist')
+
+
+def _commands(queries):
+    '''Send all queries in one command list. Returns a list telling for each
+    query whether it succeeded.'''
+    results = get_queries(queries)
+    invalidate('playlist')
+    return [r is not None for r in results]
 
 
 def clear():
-    get_query('clear')
+    _command('clear')
 
 
 def add(song):
-    get_query('add "{}"'.format(song.path))
+    _command('add {}'.format(quote(song.path)))
+
+
+def add_many(songs):
+    return _commands('add {}'.format(quote(s.path)) for s in songs)
+
+
+def _album_query(song):
+    query = 'findadd AlbumArtist {} Date {} Album {}'
+    return query.format(quote(song.albumartist), quote(song.date), quote(song.album))
 
 
 def add_album(song):
-    query = 'findadd AlbumArtist "{}" Date "{}" Album "{}"'
-    get_query(query.format(song.albumartist, song.date, song.album))
+    _command(_album_query(song))
+
+
+def add_albums(songs):
+    '''Add the albums of all given songs.'''
+    return _commands(_album_query(s) for s in songs)
+
+
+def import_m3u(path):
+    '''Add the files listed in an M3U playlist. Relative entries are taken
+    relative to the playlist, entries inside the music directory are added
+    by their path in the library.'''
+    base = os.path.dirname(os.path.abspath(path))
+    music_dir = get_music_dir()
+    files = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '://' not in line:
+                line = os.path.normpath(os.path.join(base, line))
+                if line.startswith(music_dir + os.sep):
+                    line = os.path.relpath(line, music_dir)
+            files.append(line)
+    return _commands('add {}'.format(quote(f)) for f in files)
 
 
 def remove(index):
-    get_query('delete {}'.format(index))
+    _command('delete {}'.format(index))
+
+
+def remove_range(start, end):
+    '''Remove the songs from index start up to, not including, end.'''
+    _command('delete {}:{}'.format(start, end))
 
 
 def move(index, to):
-    get_query('move {} {}'.format(index, to))
+    _command('move {} {}'.format(index, to))
+
+
+def move_many(moves):
+    '''Apply a list of (index, to) moves in order.'''
+    return _commands('move {} {}'.format(index, to) for (index, to) in moves)
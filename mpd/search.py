@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+import unicodedata
+from bisect import bisect_left
+
+_word = re.compile(r'\w+')
+
+
+def tokenize(text):
+    '''Split text into lower case words without accents.'''
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _word.findall(text)
+
+
+class SearchIndex(object):
+    '''An inverted index from the words in the tags of songs to their hashes.
+    Every search term matches all words it is a prefix of, and a song has to
+    match all terms of a query.'''
+    tags = ('title', 'artist', 'album', 'albumartist')
+
+    def __init__(self, songs):
+        '''Build the index from a dict mapping song hashes to songs.'''
+        postings = dict()
+        for song_hash, song in songs.items():
+            for tag in SearchIndex.tags:
+                for token in tokenize(getattr(song, tag, '')):
+                    postings.setdefault(token, set()).add(song_hash)
+        self.postings = postings
+        self.tokens = sorted(postings)
+
+    def _prefix_matches(self, term):
+        start = bisect_left(self.tokens, term)
+        end = bisect_left(self.tokens, term + '\U0010ffff', start)
+        if end - start == 1:
+            return self.postings[self.tokens[start]]
+        return set().union(*(self.postings[t] for t in self.tokens[start:end]))
+
+    def search(self, query):
+        '''Return the set of hashes of the songs matching all terms.'''
+        result = None
+        # look up longer terms first, they tend to match fewer songs
+        for term in sorted(set(tokenize(query)), key=len, reverse=True):
+            matches = self._prefix_matches(term)
+            result = set(matches) if result is None else result & matches
+            if not result:
+                break
+        return result or set()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import socket
+import threading
+import time
+
+from mpd.daemon import Connection
+
+SUBSYSTEMS = ('player', 'playlist', 'options', 'mixer', 'database')
+RECONNECT_DELAY = 1.0  # seconds to wait before reconnecting after an error
+
+_watcher = None
+_caches = []
+_subscribers = dict((s, []) for s in SUBSYSTEMS)
+_lock = threading.Lock()
+
+
+class Cache(object):
+    '''A value fetched from mpd that is kept until mpd reports a change in one
+    of the given subsystems. Without a running watcher, every get() fetches
+    the value again.'''
+
+    def __init__(self, fetch, subsystems):
+        self.fetch = fetch
+        self.subsystems = subsystems
+        self.lock = threading.Lock()
+        self.value = None
+        self.valid = False
+        self.generation = 0  # increased on every invalidation
+        with _lock:
+            _caches.append(self)
+
+    def get(self):
+        if not is_watching():
+            return self.fetch()
+        with self.lock:
+            if self.valid:
+                return self.value
+            generation = self.generation
+        value = self.fetch()
+        with self.lock:
+            # do not keep a value that may predate a change reported meanwhile
+            if generation == self.generation:
+                self.value, self.valid = value, True
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.valid = False
+            self.generation += 1
+
+
+class Watcher(threading.Thread):
+    '''Keeps an idle connection to mpd open, updates the caches and calls the
+    subscribers of every subsystem mpd reports a change in.'''
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('mpd-watcher')
+        self.path = path
+        self.conn = None
+        self.watching = False
+        self.running = True
+        threading.Thread.__init__(self, daemon=True)
+
+    def run(self):
+        while self.running:
+            try:
+                self.conn = Connection(self.path)
+                self.watching = True
+                # anything may have changed while we were not connected
+                self.changed(SUBSYSTEMS)
+                query = 'idle {}'.format(' '.join(SUBSYSTEMS))
+                while self.running:
+                    lines = self.conn.query(query)
+                    self.changed([l.split(': ', 1)[1] for l in lines or []])
+            except OSError as e:
+                self.watching = False
+                if self.running:
+                    self.logger.warning('lost idle connection to mpd ({})'.format(e))
+                    time.sleep(RECONNECT_DELAY)
+            finally:
+                self.watching = False
+                if self.conn is not None:
+                    self.conn.close()
+
+    def changed(self, subsystems):
+        self.logger.debug('changed: {}'.format(' '.join(subsystems)))
+        invalidate(*subsystems)
+        with _lock:
+            caches = [c for c in _caches if set(c.subsystems) & set(subsystems)]
+            callbacks = [(s, cb) for s in subsystems for cb in _subscribers.get(s, [])]
+        # refresh now, so readers find up-to-date values in memory
+        for cache in caches:
+            try:
+                cache.get()
+            except Exception as e:
+                self.logger.exception(e)
+        for subsystem, callback in callbacks:
+            try:
+                callback(subsystem)
+            except Exception as e:
+                self.logger.exception(e)
+
+    def stop(self):
+        self.running = False
+        if self.conn is not None:
+            try:
+                self.conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def start(path):
+    '''Start watching the mpd instance listening on the given socket.'''
+    global _watcher
+    stop()
+    _watcher = Watcher(path)
+    _watcher.start()
+
+
+def stop():
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
+    invalidate(*SUBSYSTEMS)
+
+
+def is_watching():
+    return _watcher is not None and _watcher.watching
+
+
+def invalidate(*subsystems):
+    '''Drop the cached values depending on the given subsystems, e.g. after
+    sending a command that changes them.'''
+    with _lock:
+        caches = [c for c in _caches if set(c.subsystems) & set(subsystems)]
+    for cache in caches:
+        cache.invalidate()
+
+
+def subscribe(subsystem, callback):
+    '''Call callback(subsystem) from the watcher thread whenever mpd reports a
+    change in the given subsystem.'''
+    with _lock:
+        _subscribers[subsystem].append(callback)
+
+
+def unsubscribe(subsystem, callback):
+    with _lock:
+        _subscribers[subsystem].remove(callback)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+from network import get_port, parse_address
+from network import peer
+from network.overlay import Overlay
+import proto
+
+
+class AsyncPeer(asyncio.Protocol):
+    '''A connection to a remote peer, driven by the event loop of an
+    AsyncOverlay. It offers the same interface to the overlay as a Peer, and
+    is used as the key of its own events.'''
+
+    def __init__(self, overlay, address=None):
+        self.overlay = overlay
+        self.address = None if address is None else parse_address(address)
+        self.logger = logging.getLogger('peer')
+        self.inbox = self
+
+        self.encoding = 'pickle'
+        self.compression = ()
+        self.reader = proto.FrameReader()
+
+        self.transport = None
+        self.pending = []  # frames sent before the connection was made
+        self.paused_since = None  # time since the transport buffer is full
+        self.dropped = 0
+        self.closing = False
+        self.state = "disconnected"
+
+    async def connect(self):
+        self.state = "connecting"
+        host, port = self.address
+        try:
+            await self.overlay.loop.create_connection(lambda: self, host, port)
+        except OSError as e:
+            self.logger.warning('cannot connect to {} ({})'.format(self, e))
+            self.connection_lost(e)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.address is None:
+            # accepted from the listen socket
+            self.address = transport.get_extra_info('peername')[:2]
+            self.overlay.queue_to_peer[self.inbox] = self
+        self.state = "connected"
+        transport.write(proto.encode(proto.Hello(get_port())))
+        for frame in self.pending:
+            transport.write(frame)
+        self.pending = []
+        if self.closing:
+            transport.write_eof()
+
+    def data_received(self, data):
+        try:
+            messages = self.reader.feed(data)
+        except ValueError as e:
+            self.logger.warning('invalid message from {} ({})'.format(self, e))
+            self.transport.abort()
+            return
+        for msg in messages:
+            if isinstance(msg, proto.Hello):
+                # update the remote port
+                ip, port = self.address
+                self.address = (ip, msg.get_port())
+                self.encoding = proto.negotiate(getattr(msg, 'codecs', ()))
+                self.compression = proto.negotiate_compression(getattr(msg, 'compression', ()))
+                continue
+            self.overlay._peer_event(self.inbox, msg)
+
+    def pause_writing(self):
+        self.paused_since = time.monotonic()
+
+    def resume_writing(self):
+        self.paused_since = None
+
+    def connection_lost(self, exc):
+        self.logger.info('TCP connection was closed')
+        self.state = "disconnected"
+        self.transport = None
+        self.closing = True
+        self.overlay._peer_event(self.inbox, None)
+
+    def get_state(self):
+        return self.state
+
+    def get_address(self):
+        return self.address
+
+    def get_address_str(self):
+        ip, port = self.get_address()
+        return '{}:{}'.format(ip, port)
+
+    def send(self, message):
+        '''Send a protocol message to the remote peer. The transport buffers
+        what cannot be written at once, so this never blocks. While the peer
+        does not keep up, bulk messages are dropped, and all messages once
+        the buffer exceeds the limit of a Peer's queue.'''
+        self.logger.debug('sending {} -> {}'.format(type(message), self))
+        if self.closing:
+            return
+        if self.transport is None:
+            self.pending.append(proto.encode(message, self.encoding, self.compression))
+            return
+        max_queued, _ = peer.get_send_limits()
+        if ((self.paused_since is not None and isinstance(message, peer.BULK_MESSAGES)) or
+                self.transport.get_write_buffer_size() > max_queued):
+            if not self.dropped:
+                self.logger.warning('peer {} does not keep up, dropping messages'.format(self))
+            self.dropped += 1
+            return
+        self.transport.write(proto.encode(message, self.encoding, self.compression))
+
+    def is_slow(self):
+        _, slow_after = peer.get_send_limits()
+        paused_since = self.paused_since
+        return paused_since is not None and time.monotonic() - paused_since > slow_after
+
+    def get_send_stats(self):
+        queued = 0 if self.transport is None else self.transport.get_write_buffer_size()
+        return {'queued': queued, 'dropped': self.dropped, 'slow': self.is_slow()}
+
+    def disconnect(self):
+        self.logger.debug('closing connection to peer {}'.format(self))
+        self.state = "disconnected"
+        if self.transport is not None:
+            self.transport.write_eof()
+        self.closing = True
+
+    def __str__(self):
+        return '{}'.format(self.get_address())
+
+
+class AsyncOverlay(Overlay):
+    '''An overlay handling the listen socket, all peers and the user commands
+    in one asyncio event loop instead of a thread for each of them. Outgoing
+    connections are made in the background: a peer that cannot be reached
+    is reported as closed, like a connection that broke.'''
+
+    def _setup_engine(self):
+        self.loop = asyncio.new_event_loop()
+        self.listen.setblocking(False)
+
+    def put_cmd(self, cmd):
+        self.loop.call_soon_threadsafe(self._user_event, cmd)
+
+    def _remove_source(self, inqueue):
+        pass
+
+    def _open_peer(self, address):
+        new_peer = AsyncPeer(self, address)
+        self.queue_to_peer[new_peer.inbox] = new_peer
+        self.loop.create_task(new_peer.connect())
+        return new_peer
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(
+            self.loop.create_server(lambda: AsyncPeer(self), sock=self.listen))
+        self.loop.run_forever()
@@ -1,35 +1,212 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from collections import deque
 import logging
+import queue
+import select
 import socket
 import socketserver
 import threading
+import time
 
+from bloom_filter import BloomFilter
+from fingerprint_set import FingerprintSet, to_hex
+from minhash import MinHashSignature
 import mpd
 import network
+from network.peer import send_frames
 import proto
 
+PONG_ERROR_RATE = 0.01  # false positive rate of the music summary in pongs
+MUSIC_HISTORY = 16  # versions of the group music peers can catch up from
+MUSIC_PAGE_SIZE = 50  # songs per page when showing the group music
+CONNECT_TIMEOUT = 10  # seconds to wait for a group member, also when sending
+
+
+class GroupConnection(threading.Thread):
+    '''A long-lived connection to the leader or a member of the group. Frames
+    are sent in order by a thread of its own, so a member that is slow or
+    gone only delays the messages to itself. The connection is opened with
+    the first message, and again after it broke. Nodes from before binary
+    frames read only one message per connection, they get a connection for
+    every frame once per_message is set.'''
+
+    def __init__(self, address):
+        self.logger = logging.getLogger('group_connection')
+        self.address = address
+        self.sock = None
+        self.per_message = False
+        self.frames = queue.Queue()
+        # delivery of the frames so far
+        self.status = {'sent': 0, 'failed': 0, 'error': None, 'last_sent': None}
+
+        threading.Thread.__init__(self, daemon=True)
+        self.start()
+
+    def send(self, frame):
+        self.frames.put(frame)
+
+    def close(self):
+        '''Close the connection once the queued frames are sent.'''
+        self.frames.put(None)
+
+    def _drop_socket(self):
+        self.sock.close()
+        self.sock = None
+
+    def _is_closed(self):
+        # group servers never answer, so a readable socket was closed by
+        # the other side
+        poll = select.poll()
+        poll.register(self.sock, select.POLLIN)
+        return bool(poll.poll(0))
+
+    def _send(self, frames):
+        if not self.per_message:
+            self._deliver(frames)
+            return
+        for frame in frames:
+            self._deliver([frame])
+            if self.sock is not None:
+                self._drop_socket()
+
+    def _deliver(self, frames):
+        if self.sock is not None and self._is_closed():
+            self.logger.debug('connection to {} was closed'.format(self.address))
+            self._drop_socket()
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(network.parse_address(self.address),
+                                                     CONNECT_TIMEOUT)
+            send_frames(self.sock, frames)
+        except OSError as e:
+            self.logger.warning('cannot send to group member {} ({})'.format(self.address, e))
+            self.status['failed'] += len(frames)
+            self.status['error'] = str(e)
+            if self.sock is not None:
+                self._drop_socket()
+            return
+        self.status['sent'] += len(frames)
+        self.status['error'] = None
+        self.status['last_sent'] = time.time()
+
+    def run(self):
+        while True:
+            # send all frames queued by now in one go
+            frames = [self.frames.get()]
+            try:
+                while frames[-1] is not None:
+                    frames.append(self.frames.get_nowait())
+            except queue.Empty:
+                pass
+            if frames[-1] is None:
+                if len(frames) > 1:
+                    self._send(frames[:-1])
+                if self.sock is not None:
+                    self._drop_socket()
+                return
+            self._send(frames)
+
+
+class BasicGroupServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''Receives group messages, on a connection per member that is kept
+    open. Connections are handled in parallel, the group state is guarded by
+    a lock. The group music is never changed in place, but replaced, so it
+    can be read without the lock.'''
+    daemon_threads = True
+    request_queue_size = 128  # members joining at the same time
+    allow_reuse_address = True  # closed connections may keep the port for a while
+    _summary = None  # (music, BloomFilter of music)
+    _signature = None  # (music, MinHashSignature of music)
+    _listing = None  # (music, sorted listing, case folded texts)
+
+    def __init__(self, address, handler):
+        self.lock = threading.Lock()  # held while changing the group state
+        self.requests = set()  # open incoming connections
+        self.connections = dict()  # address -> GroupConnection
+        self.connections_lock = threading.Lock()
+        super().__init__(address, handler)
+
+    def get_connection(self, address):
+        with self.connections_lock:
+            connection = self.connections.get(address)
+            if connection is None:
+                connection = GroupConnection(address)
+                self.connections[address] = connection
+            return connection
+
+    def close_connection(self, address):
+        with self.connections_lock:
+            connection = self.connections.pop(address, None)
+        if connection is not None:
+            connection.close()
+
+    def get_delivery_status(self):
+        '''Return the delivery status of the messages sent to each member.'''
+        with self.connections_lock:
+            return dict((a, dict(c.status)) for (a, c) in self.connections.items())
 
-class BasicGroupServer(socketserver.TCPServer):
     def update_music(self, hashes):
         # update music by intersection
         self.music = self.music & hashes
         self.logger.debug('updating music {}'.format(len(self.music)))
 
-    def show_music(self):
-        songs = ((h, mpd.music.get_song(h)) for h in self.music)
-        songs_txt = sorted('{}  {}  ({})'.format(s.artist, s.title, h) for (h, s) in songs)
-        for i, s in enumerate(songs_txt):
-            print('[{}] {}'.format(i, s))
+    def get_summary(self):
+        '''Return a BloomFilter of the group music, as sent in group pongs.'''
+        music = self.music
+        if self._summary is None or self._summary[0] is not music:
+            self._summary = (music, BloomFilter.from_items(music, PONG_ERROR_RATE))
+        return self._summary[1]
+
+    def get_signature(self):
+        '''Return the MinHash signature of the group music.'''
+        music = self.music
+        if self._signature is None or self._signature[0] is not music:
+            self._signature = (music, MinHashSignature(music))
+        return self._signature[1]
+
+    def get_listing(self):
+        '''Return the group music as a sorted list of (text, hash) pairs. The
+        position in the list is the song number used by the user.'''
+        music = self.music
+        if self._listing is None or self._listing[0] is not music:
+            songs = mpd.music.get_songs_for(music)
+            listing = sorted(('{}  {}'.format(s.artist, s.title), h)
+                             for (h, s) in zip(music, songs))
+            folded = [text.casefold() for (text, _) in listing]
+            self._listing = (music, listing, folded)
+        return self._listing[1]
+
+    def show_music(self, page=None, text=None):
+        '''Print the group music, optionally only one page of it and only the
+        songs containing the given text.'''
+        listing = self.get_listing()
+        numbers = range(len(listing))
+        if text:
+            text = text.casefold()
+            folded = self._listing[2]
+            numbers = [i for i in numbers if text in folded[i]]
+        if page is not None:
+            numbers = numbers[page * MUSIC_PAGE_SIZE:(page + 1) * MUSIC_PAGE_SIZE]
+        for i in numbers:
+            song_text, h = listing[i]
+            print('[{}] {}  ({})'.format(i, song_text, to_hex(h)))
 
     def get_hash(self, song_no):
-        songs = ((h, mpd.music.get_song(h)) for h in self.music)
-        songs_txt = sorted('{}  {}  ({})'.format(s.artist, s.title, h) for (h, s) in songs)
-        return songs_txt[song_no].rsplit('(', maxsplit=1)[1][:-1]
+        return self.get_listing()[song_no][1]
 
     def stop(self):
         self.shutdown()
         self.server_close()
+        for request in list(self.requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        with self.connections_lock:
+            connections, self.connections = self.connections, dict()
+        for connection in connections.values():
+            connection.close()
 
 
 class ServerLogger:
@@ -38,86 +215,237 @@ class ServerLogger:
         return self.server.logger
 
 
+class GroupHandler(ServerLogger, socketserver.BaseRequestHandler):
+    '''Handles the messages arriving on a connection until it is closed.'''
+    def handle(self):
+        self.server.requests.add(self.request)
+        try:
+            reader = proto.FrameReader(self.request)
+            while True:
+                msg = reader.read()
+                if msg is None:
+                    return
+                self.logger.debug('received {}'.format(type(msg)))
+                self.handle_message(msg)
+        finally:
+            self.server.requests.discard(self.request)
+
+
 class GroupLeader(BasicGroupServer):
-    '''Create new group with local peer as leader'''
-    def __init__(self):
+    '''Create new group with local peer as leader. Requests only change the
+    group state, the resulting messages are sent by the broadcaster thread:
+    playlist changes in the order they arrived, group info and music once for
+    all changes made meanwhile.'''
+    def __init__(self, music=None):
         self.logger = logging.getLogger('group_leader')
 
         self.peers = set()
-        self.music = mpd.music.get_hashes()
+        self.music = mpd.music.get_hashes() if music is None else music
+        self.version = 0
+        self.history = deque(maxlen=MUSIC_HISTORY)  # (version, removed songs)
+        self.acked = dict()  # peer -> last group music version it confirmed
+        self.encodings = dict()  # peer -> encoding of the messages sent to it
+
+        # work of the broadcaster
+        self.playlist_changes = deque()
+        self.info_pending = False  # the peers changed
+        self.music_pending = set()  # peers that may need a music update
+        self.stopped = False
 
         address = network.parse_address(network.get_group_address())
 
         self.logger.info('starting group leader server on {}'.format(address))
 
         super().__init__(address, GroupLeaderHandler)
+        self.changed = threading.Condition(self.lock)
+        self.broadcaster = threading.Thread(target=self.broadcast, daemon=True)
+        self.broadcaster.start()
         self.thread = threading.Thread(target=self.serve_forever, daemon=True)
         self.thread.start()
 
-    def add_peer(self, a, p):
+    def add_peer(self, a, p, codecs=()):
         peer = '{}:{}'.format(a, p)
-        self.peers.add(peer)
-        m = proto.GroupInfo(network.get_group_address(), self.peers)
-        self.send_all(m)
+        with self.changed:
+            self.peers.add(peer)
+            self.encodings[peer] = proto.negotiate(codecs)
+            self.get_connection(peer).per_message = self.encodings[peer] == 'pickle'
+            self.info_pending = True
+            self.changed.notify()
 
     def remove_peer(self, a, p):
         peer = '{}:{}'.format(a, p)
-        self.peers.remove(peer)
-        m = proto.GroupInfo(network.get_group_address(), self.peers)
-        self.send_all(m)
+        with self.changed:
+            self.peers.discard(peer)
+            self.acked.pop(peer, None)
+            self.encodings.pop(peer, None)
+            self.music_pending.discard(peer)
+            self.info_pending = True
+            self.changed.notify()
+            # under the lock, so no message is sent to the peer afterwards
+            self.close_connection(peer)
+
+    def update_music(self, hashes):
+        while True:
+            # intersect without holding the lock, and again if the music
+            # was changed meanwhile
+            old = self.music
+            music = old & hashes
+            removed = old - music
+            with self.lock:
+                if self.music is old:
+                    self.music = music
+                    if len(removed):
+                        self.version += 1
+                        self.history.append((self.version, removed))
+                    break
+        self.logger.debug('updating music {}'.format(len(music)))
+
+    def music_update(self, peer):
+        '''Return the GroupMusic message bringing a peer to the current
+        version, or None if it is up to date. Must be called with the lock
+        held.'''
+        base = self.acked.get(peer)
+        if base == self.version:
+            return None
+        if base is None or not self.history or base < self.history[0][0] - 1:
+            # unknown or too far behind
+            return proto.GroupMusic(self.music, self.version)
+        removed = FingerprintSet(h for (v, r) in self.history if v > base for h in r)
+        return proto.GroupMusic.delta(base, self.version, removed)
+
+    def send_music(self, peers=None):
+        with self.changed:
+            self.music_pending.update(self.peers if peers is None else peers)
+            self.changed.notify()
+
+    def ack_music(self, a, p, version):
+        peer = '{}:{}'.format(a, p)
+        with self.lock:
+            if peer not in self.peers:
+                return
+            self.acked[peer] = version
+        if version != self.version:
+            self.send_music([peer])
+
+    def update_playlist(self, msg):
+        '''Apply a playlist change and send it to all peers, after the
+        changes queued before.'''
+        with self.changed:
+            self.playlist_changes.append(msg)
+            self.changed.notify()
+
+    def broadcast(self):
+        while True:
+            with self.changed:
+                while not (self.stopped or self.playlist_changes or
+                           self.info_pending or self.music_pending):
+                    self.changed.wait()
+                if self.stopped:
+                    return
+                playlist_changes, self.playlist_changes = self.playlist_changes, deque()
+                info = None
+                if self.info_pending:
+                    info = proto.GroupInfo(network.get_group_address(), set(self.peers))
+                    self.info_pending = False
+                # peers at the same version get the same message
+                updates = dict()  # base version -> message
+                music = []
+                for p in self.music_pending & self.peers:
+                    base = self.acked.get(p)
+                    if base not in updates:
+                        updates[base] = self.music_update(p)
+                    if updates[base] is not None:
+                        music.append((p, updates[base]))
+                self.music_pending = set()
+
+            # a failing message must not stop the broadcaster
+            for msg in playlist_changes:
+                try:
+                    msg.do()
+                    self.send_all(msg)
+                except Exception as e:
+                    self.logger.exception(e)
+            try:
+                if info is not None:
+                    self.send_all(info)
+                self.send_each(music)
+            except Exception as e:
+                self.logger.exception(e)
 
     def send_all(self, m):
-        for p in self.peers:
-            GroupLeader.send_peer(p, m)
+        '''Send a message to all peers.'''
+        with self.lock:
+            peers = list(self.peers)
+        self.send_each([(p, m) for p in peers])
+
+    def send_each(self, messages):
+        '''Send (peer, message) pairs. Messages are encoded only once for
+        all peers using the same encoding. Peers that were removed meanwhile
+        are skipped, their connections are closed already.'''
+        frames = dict()  # (message, encoding) -> frames
+        for (p, m) in messages:
+            with self.lock:
+                if p not in self.peers:
+                    continue
+                connection = self.get_connection(p)
+                encoding = self.encodings.get(p, 'pickle')
+            key = (id(m), encoding)
+            if key not in frames:
+                frames[key] = proto.encode_frames(m, encoding)
+            for frame in frames[key]:
+                connection.send(frame)
+
+    def send_peer(self, p, m):
+        self.send_each([(p, m)])
 
-    @staticmethod
-    def send_peer(p, m):
-        with socket.socket() as sock:
-            sock.settimeout(10)  # TODO: Handle timeout exception
-            sock.connect(network.parse_address(p))
-            sock.sendall(bytes(m))
+    def stop(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify()
+        super().stop()
 
     def leave(self):
-        self.stop()
         m = proto.GroupLeave()
         self.send_all(m)
+        self.stop()
 
     def play(self, index=0):
-        mpd.playback.play(index)
-        self.send_all(proto.GroupPlaylist.play(index))
+        self.update_playlist(proto.GroupPlaylist.play(index))
 
     def add_song(self, song_no):
         song = self.get_hash(song_no)
         if song in self.music:
-            msg = proto.GroupPlaylist.add(song)
-            msg.do()
-            self.send_all(msg)
+            self.update_playlist(proto.GroupPlaylist.add(song))
 
+    def add_songs(self, song_nos):
+        songs = [h for h in (self.get_hash(n) for n in song_nos) if h in self.music]
+        if songs:
+            self.update_playlist(proto.GroupPlaylist.add_many(songs))
 
-class GroupLeaderHandler(ServerLogger, socketserver.BaseRequestHandler):
-    '''Handler for incoming group messages'''
-    def handle(self):
-        # msg = proto.parse(self.rfile.readline())
-        msg = proto.receive(self.request)
-        self.logger.debug('received {}'.format(type(msg)))
 
+class GroupLeaderHandler(GroupHandler):
+    '''Handler for incoming group messages'''
+    def handle_message(self, msg):
         if isinstance(msg, proto.GroupJoin):
             # peer wants to join group
             self.logger.debug('join request from {} ({})'.format(self.client_address[0], msg.port))
             # answer with GroupInfo
-            self.server.add_peer(self.client_address[0], msg.port)
+            self.server.add_peer(self.client_address[0], msg.port,
+                                 getattr(msg, 'codecs', ()))
 
         elif isinstance(msg, proto.GroupMusic):
             self.server.update_music(msg.hashes)
-            self.server.send_all(proto.GroupMusic(self.server.music))
+            self.server.send_music()
+
+        elif isinstance(msg, proto.GroupMusicAck):
+            self.server.ack_music(self.client_address[0], msg.port, msg.version)
 
         elif isinstance(msg, proto.GroupLeave):
             self.logger.debug('peer leaving: {} ({})'.format(self.client_address[0], msg.port))
             self.server.remove_peer(self.client_address[0], msg.port)
 
         elif isinstance(msg, proto.GroupPlaylist):
-            msg.do()
-            self.server.send_all(msg)
+            self.server.update_playlist(msg)
 
 
 class GroupPeer(BasicGroupServer):
@@ -127,8 +455,11 @@ class GroupPeer(BasicGroupServer):
 
         self.leader = leader
         self.music = mpd.music.get_hashes()
+        self.version = None  # version of the group music we have
         self.peers = set()
         self.join_pending = True
+        # the leader's GroupInfo tells us if it understands binary messages
+        self.encoding = 'pickle'
 
         # start server for group messages
         address = network.get_group_address()
@@ -151,22 +482,43 @@ class GroupPeer(BasicGroupServer):
         self.update_peers(info.peers)
         if self.join_pending:
             # first GroupInfo - get leader and peers
+            if info.leader != self.leader:
+                self.close_connection(self.leader)
             self.leader = info.leader
             self.join_pending = False
-            # send GroupMusic to leader
+            self.encoding = proto.negotiate(getattr(info, 'codecs', ()))
+            self.get_connection(self.leader).per_message = self.encoding == 'pickle'
+            # send our exact music to the leader, the group music may only
+            # contain songs every member has
             self.send_leader(proto.GroupMusic(self.music))
             self.logger.debug('group join complete')
 
     def send_leader(self, m):
         self.logger.debug('sending {} to leader {}'.format(m, self.leader))
-        with socket.socket() as sock:
-            sock.settimeout(10)  # TODO: Handle timeout exception
-            sock.connect(network.parse_address(self.leader))
-            sock.sendall(bytes(m))
+        connection = self.get_connection(self.leader)
+        for frame in proto.encode_frames(m, self.encoding):
+            connection.send(frame)
 
     def send_all(self, m):
         self.send_leader(m)
 
+    def receive_music(self, msg):
+        '''Apply a GroupMusic message from the leader and confirm the version
+        we have now.'''
+        if msg.is_delta():
+            if msg.base == self.version:
+                self.music = self.music - msg.removed
+                self.version = msg.version
+                self.logger.debug('updating music {}'.format(len(self.music)))
+            else:
+                self.logger.debug('cannot apply music delta from version {}'
+                                  .format(msg.base))
+        else:
+            self.update_music(msg.hashes)
+            self.version = getattr(msg, 'version', None)
+        if self.version is not None:
+            self.send_leader(proto.GroupMusicAck(self.version))
+
     def leave(self):
         self.logger.debug('leaving group')
         self.send_leader(proto.GroupLeave())
@@ -178,20 +530,27 @@ class GroupPeer(BasicGroupServer):
             msg = proto.GroupPlaylist.add(song)
             self.send_all(msg)
 
+    def add_songs(self, song_nos):
+        songs = [h for h in (self.get_hash(n) for n in song_nos) if h in self.music]
+        if songs:
+            self.send_all(proto.GroupPlaylist.add_many(songs))
+
     def play(self, index=0):
         self.send_all(proto.GroupPlaylist.play(index))
 
 
-class GroupPeerHandler(ServerLogger, socketserver.BaseRequestHandler):
+class GroupPeerHandler(GroupHandler):
     '''Handler for incoming group messages'''
-    def handle(self):
-        msg = proto.receive(self.request)
-        self.logger.debug('received {}'.format(type(msg)))
+    def handle_message(self, msg):
+        with self.server.lock:
+            self.handle_leader_message(msg)
+
+    def handle_leader_message(self, msg):
         if isinstance(msg, proto.GroupInfo):
             self.server.update(msg)
 
         elif isinstance(msg, proto.GroupMusic):
-            self.server.update_music(msg.hashes)
+            self.server.receive_music(msg)
 
         elif isinstance(msg, proto.GroupLeave):
             # TODO: this is hacky because the overlay still has a reference
@@ -13,7 +13,7 @@ from network.connection_waiter import ConnectionWaiter
 from network.group import GroupLeader, GroupPeer
 from network.peer import Peer
 import proto
-from signalqueue import QueueSet
+from signalqueue import QueueSet, PRIORITY_HIGH
 from bounded_dict import BoundedDict
 
 N_NEIGHBOURS = 2  # number of neighbours every node tries to have
@@ -32,12 +32,9 @@ class Overlay(threading.Thread):
             'pings': dict(),
             'group': None,
             'group_pings': BoundedDict(16384),
-            'group_candidates': dict()
+            'group_candidates': dict()  # leader -> score
         }
 
-        self.queues = QueueSet()
-        self.cmdqueue = self.queues.New()  # commands by the user
-
         self.queue_to_peer = dict()  # remember which queue was used for which peer
 
         # open up our own listen socket
@@ -49,21 +46,58 @@ class Overlay(threading.Thread):
         self.listen.listen(10)
         self.logger.info('server socket established')
 
-        # the queue that will be used for signalling new connections
-        self.listenQ = self.queues.New()
-
-        self.listen_thread = ConnectionWaiter(self.listen, self.listenQ)
-        self.listen_thread.start()
+        self._setup_engine()
 
         # connect to the overlay
         if entrypeers:
-            self.cmdqueue.put('join {}'.format(" ".join(entrypeers)))
+            self.put_cmd('join {}'.format(" ".join(entrypeers)))
 
         threading.Thread.__init__(self, daemon=True)
 
+    def _setup_engine(self):
+        '''Prepare the delivery of events: every peer and the listen socket
+        get a thread, which put their events into queues of a QueueSet.'''
+        self.queues = QueueSet()
+        # commands by the user, handled before waiting peer messages
+        self.cmdqueue = self.queues.New(PRIORITY_HIGH)
+
+        # the queue that will be used for signalling new connections
+        self.listenQ = self.queues.New()
+
+        self.listen_thread = ConnectionWaiter(self.listen, self.listenQ)
+        self.listen_thread.start()
+
     def put_cmd(self, cmd):
         self.cmdqueue.put(cmd)
 
+    def _remove_source(self, inqueue):
+        '''Stop waiting for events of a closed peer.'''
+        self.queues.remove(inqueue)
+
+    def _open_peer(self, address):
+        '''Start a peer that connects in the background and receives its
+        messages. A peer that cannot be reached is reported as closed, like
+        a connection that broke.'''
+        new_queue = self.queues.New()
+        try:
+            new_peer = Peer(address, new_queue)
+        except ValueError:
+            # not an address, the queue would never be used
+            self._remove_source(new_queue)
+            raise
+        self.queue_to_peer[new_queue] = new_peer
+        new_peer.start()
+        return new_peer
+
+    def _check_sample(self, peer, hashes):
+        '''Return the percentage of the songs sent by a peer that we have, or
+        None if they cannot be compared with ours.'''
+        try:
+            return mpd.music.check_sample(hashes)
+        except Exception as e:
+            self.logger.warning('cannot check the songs from {} ({})'.format(peer, e))
+            return None
+
     def find_group(self):
         """Send a group ping to identify groups"""
         ping_id = uuid.uuid4()
@@ -103,25 +137,19 @@ class Overlay(threading.Thread):
             self.logger.info('joining the overlay')
             self.state['joining'] = {'candidates': args[1:]}
 
-            new_queue = self.queues.New()
             for entry_addr in self.state['joining']['candidates']:
                 self.state['joining']['candidates'].remove(entry_addr)
                 try:
                     self.logger.info('trying to join via {}'.format(entry_addr))
-                    new_peer = Peer(entry_addr, new_queue)
-                    new_peer.connect()
+                    new_peer = self._open_peer(entry_addr)
                     break
-                except OSError as e:
+                except ValueError as e:
                     self.logger.warning('cannot join via {} ({})'.format(entry_addr, e))
             else:
                 self.logger.error('no entry peer available, cannot join')
                 self.state['joining'] = None
-                self.queues.remove(new_queue)
                 return
 
-            self.queue_to_peer[new_queue] = new_peer
-            new_peer.start()
-
             ping_id = str(uuid.uuid4())
             self.state['joining']['current_entry'] = new_peer
             self.state['joining']['ping_id'] = ping_id
@@ -139,8 +167,9 @@ class Overlay(threading.Thread):
                 if len(args[2:]) > 2:
                     self.state['group'] = GroupPeer(args[-1])
                 elif self.state['group_candidates']:
-                    best = max(self.state['group_candidates'].keys())
-                    self.state['group'] = GroupPeer(self.state['group_candidates'][best])
+                    candidates = self.state['group_candidates']
+                    best = max(candidates, key=candidates.get)
+                    self.state['group'] = GroupPeer(best)
                     self.state['group_candidates'] = dict()
             elif group_cmd == 'find':
                 self.find_group()
@@ -149,7 +178,10 @@ class Overlay(threading.Thread):
                     self.state['group'].leave()
                     self.state['group'] = None
                 elif group_cmd == 'music':
-                    self.state['group'].show_music()
+                    page, text = None, args[2:]
+                    if text and text[0].isdigit():
+                        page, text = int(text[0]), text[1:]
+                    self.state['group'].show_music(page, ' '.join(text))
                 elif group_cmd == 'play':
                     try:
                         index = int(args[-1])
@@ -158,9 +190,14 @@ class Overlay(threading.Thread):
                     self.state['group'].play(index)
                 elif group_cmd == 'add':
                     try:
-                        self.state['group'].add_song(int(args[-1]))
+                        song_nos = [int(a) for a in args[2:]]
                     except ValueError:
                         self.logger.warn("invalid song index")
+                    else:
+                        if len(song_nos) == 1:
+                            self.state['group'].add_song(song_nos[0])
+                        elif song_nos:
+                            self.state['group'].add_songs(song_nos)
 
         else:
             self.logger.error('unknown user command: {}'.format(cmd))
@@ -172,8 +209,8 @@ class Overlay(threading.Thread):
                                        'new -- create a new group',
                                        'find -- find available groups',
                                        'join -- join the best known group',
-                                       'music -- list group music',
-                                       'add <song_no> -- add song to group playlist',
+                                       'music [page] [text] -- list group music',
+                                       'add <song_no> [...] -- add songs to group playlist',
                                        'play [number] -- start playing song from group playlist')))
 
     def _peer_event(self, inqueue, data):
@@ -189,11 +226,11 @@ class Overlay(threading.Thread):
                 self.logger.error('error joining, entry died')
                 if len(self.state['joining']['candidates']) > 0:
                     self.logger.info('more entries to try')
-                    self.cmdqueue.put(('join',
-                                       self.state['joining']['candidates']))
-                    self.state['joining'] = None
+                    self.put_cmd('join {}'.format(
+                        ' '.join(self.state['joining']['candidates'])))
                 else:
                     self.logger.error('joining finally failed.')
+                self.state['joining'] = None
 
             # TODO remove from pongs pending list and trigger
             # processing
@@ -209,6 +246,7 @@ class Overlay(threading.Thread):
                 self.state['neighbours'].remove(peer)
 
             del self.queue_to_peer[inqueue]
+            self._remove_source(inqueue)
 
         def ping():
             p_id = data.get_id()
@@ -265,21 +303,17 @@ class Overlay(threading.Thread):
                         break
                     self.logger.debug('trying peer {} as a neighbour'.format(n))
 
-                    new_queue = self.queues.New()
                     try:
-                        new_peer = Peer(n, new_queue)
-                        new_peer.connect()
+                        new_peer = self._open_peer(n)
                         # TODO only successful if remote peer also
                         # wants to be our neighbour
-                    except OSError as e:
+                    except ValueError as e:
                         self.logger.warning('neighbour {} does not work ({})'
                                             .format(n, e))
                         continue
                     self.logger.debug('peer {} added as a neighbour'.format(n))
                     self.state['neighbours'].append(new_peer)
-                    new_peer.start()
                     new_peer.send(proto.Neighbour(force=forcing))
-                    self.queue_to_peer[new_queue] = new_peer
 
                     forcing = False
 
@@ -331,8 +365,11 @@ class Overlay(threading.Thread):
             peer.send(proto.Neighbour())
 
         def sample():
-            score = mpd.music.check_sample(data.hashes)
+            score = self._check_sample(peer, data.hashes)
             self.logger.debug('score for sample is {}'.format(score))
+            if getattr(data, 'signature', None) is not None:
+                similarity = mpd.music.check_signature(data.signature)
+                self.logger.debug('similarity for sample is {:.3f}'.format(similarity))
 
         def group_ping():
             if data.ping_id in self.state['group_pings']:
@@ -349,11 +386,18 @@ class Overlay(threading.Thread):
                 if self.state['group']:
                     # We're in a group, so we should answer
                     self.logger.debug('reply with group pong to {}'.format(peer.address))
-                    music = self.state['group'].music
+                    if peer.encoding == 'binary':
+                        music = self.state['group'].get_summary()
+                        signature = self.state['group'].get_signature()
+                    else:
+                        # nodes from before binary frames know no summaries,
+                        # they get the exact group music
+                        music, signature = self.state['group'].music, None
                     if isinstance(self.state['group'], GroupLeader):
-                        m = proto.GroupPong(data.ping_id, network.get_group_address(), music)
+                        leader = network.get_group_address()
                     elif isinstance(self.state['group'], GroupPeer):
-                        m = proto.GroupPong(data.ping_id, self.state['group'].leader, music)
+                        leader = self.state['group'].leader
+                    m = proto.GroupPong(data.ping_id, leader, music, signature)
                     peer.send(m)
 
         def group_pong():
@@ -367,10 +411,16 @@ class Overlay(threading.Thread):
                 else:
                     # we pinged
                     self.logger.debug('received pong with group candidate {}'.format(data.leader))
-                    score = mpd.music.check_sample(data.music)
+                    if getattr(data, 'signature', None) is not None:
+                        # rank by similarity, estimated from the signatures
+                        score = mpd.music.check_signature(data.signature) * 100
+                    else:
+                        score = self._check_sample(peer, data.music)
                     self.logger.debug('score for pong is {}'.format(score))
-                    if score > 0:
-                        self.state['group_candidates'][score] = data.leader
+                    candidates = self.state['group_candidates']
+                    if score is not None and score > candidates.get(data.leader, 0):
+                        # a group answers once per path, keep its best score
+                        candidates[data.leader] = score
 
         # assign handlers to data types
         handlers = {
@@ -388,27 +438,31 @@ class Overlay(threading.Thread):
 
     def run(self):
         while True:
-            (inqueue, data) = self.queues.get()
+            # handle all events that arrived meanwhile in one go
+            for (inqueue, data) in self.queues.get_many():
 
-            # determine, what kind of event occured
-            if inqueue == self.listenQ:
-                # new peer established a connection to us
-                self._listen_event(data)
+                # determine, what kind of event occured
+                if inqueue == self.listenQ:
+                    # new peer established a connection to us
+                    self._listen_event(data)
 
-            elif inqueue == self.cmdqueue:
-                # command from the user
-                self._user_event(data)
+                elif inqueue == self.cmdqueue:
+                    # command from the user
+                    self._user_event(data)
 
-            elif inqueue in self.queue_to_peer:
-                # message from another peer
-                self._peer_event(inqueue, data)
+                elif inqueue in self.queue_to_peer:
+                    # message from another peer
+                    self._peer_event(inqueue, data)
 
-            else:
-                self.logger.error('unknown input: {}'.format(data))
+                else:
+                    self.logger.error('unknown input: {}'.format(data))
 
     def print_status(self):
         print('[Peers]')
-        print('\n'.join(':'.join(p.address) for p in self.state['neighbours']))
+        for p in self.state['neighbours']:
+            s = p.get_send_stats()
+            print('{}: {} bytes queued, {} dropped{}'.format(
+                p.get_address_str(), s['queued'], s['dropped'], ', slow' if s['slow'] else ''))
 
         print('[Group]')
         if self.state['group']:
@@ -419,8 +473,28 @@ class Overlay(threading.Thread):
                 print('*peer*')
                 print(self.state['group'].leader, '*leader*')
             print('\n'.join(self.state['group'].peers))
+            delivery = self.state['group'].get_delivery_status()
+            for address in sorted(delivery):
+                s = delivery[address]
+                print('-> {}: {} sent, {} failed{}'.format(
+                    address, s['sent'], s['failed'],
+                    '' if s['error'] is None else ' ({})'.format(s['error'])))
         else:
             print('*none*')
+            candidates = self.state['group_candidates']
+            for leader in sorted(candidates, key=candidates.get, reverse=True):
+                print('{} ({:.0f})'.format(leader, candidates[leader]))
+
+        stats = proto.get_compression_stats()
+        if stats:
+            print('[Compression]')
+            for name in sorted(stats):
+                s = stats[name]
+                print('{}: {} frames, {} -> {} bytes ({}), {:.1f} ms, {} received, {:.1f} ms'
+                      .format(name, s['frames'], s['raw'], s['sent'],
+                              '-' if s['ratio'] is None else '{:.2f}'.format(s['ratio']),
+                              s['compress_time'] * 1000, s['received'],
+                              s['decompress_time'] * 1000))
 
         print('[Playlist]')
         print('\n'.join('{}: {}  {}'.format(i, s.artist, s.title)
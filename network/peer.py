@@ -1,12 +1,49 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from collections import deque
 import threading
 import socket
 import logging
+import time
 
 from network import get_port, parse_address
 import proto
 
+MAX_IOV = 1024  # frames handed to one sendmsg call
+CONNECT_TIMEOUT = 10  # seconds to wait for a connection to a peer
+# messages carrying song sets, sent after all other queued messages
+BULK_MESSAGES = (proto.Sample, proto.GroupMusic, proto.GroupPong)
+BULK_BATCH = 65536  # bytes of bulk frames sent before looking for others again
+_flush_delay = 0.0  # seconds to wait for more frames before sending
+_flush_size = 65536  # bytes that are sent without waiting any longer
+_max_queued = 4 * 1024 * 1024  # bytes queued for one peer at most
+_slow_after = 5.0  # seconds a peer's queue may stay non-empty
+
+
+def set_flush_delay(delay, size=None):
+    '''Set how long outgoing frames may wait to be sent together with later
+    ones, and the amount of data that is sent at once regardless.'''
+    global _flush_delay, _flush_size
+    _flush_delay = delay
+    if size is not None:
+        _flush_size = size
+
+
+def set_send_limits(max_queued=None, slow_after=None):
+    '''Set the number of bytes that may be queued for a peer, and after how
+    many seconds of a never empty queue a peer counts as slow.'''
+    global _max_queued, _slow_after
+    if max_queued is not None:
+        _max_queued = max_queued
+    if slow_after is not None:
+        _slow_after = slow_after
+
+
+def get_send_limits():
+    '''Return the bytes that may be queued for a peer, and the seconds after
+    which a peer counts as slow.'''
+    return _max_queued, _slow_after
+
 
 class Peer(threading.Thread):
     # TODO differentiate sending/receiving socket ???
@@ -17,10 +54,27 @@ class Peer(threading.Thread):
         self.socket_lock = threading.Lock()
 
         self.inbox = inbox  # the queue object to store incoming messages in
+        # encoding of our messages, switched to binary once the remote side
+        # announces it understands it
+        self.encoding = 'pickle'
+        self.compression = ()  # compression methods both sides know
+
+        # frames waiting to be sent by the writer thread, bulk frames are
+        # only sent when no others are waiting and dropped first if the
+        # peer does not keep up
+        self.outbox = []
+        self.bulk = deque()
+        self.outbox_size = 0  # bytes in outbox and bulk
+        self.outbox_changed = threading.Condition()
+        self.busy_since = None  # time since the queue was last empty
+        self.dropped = 0
+        self.closing = False  # shut down our side once the outbox is sent
+        self.writer = None
 
         if reuse_socket is not None:
             self.sock = reuse_socket
             self.state = "connected"
+            self._start_writer()
         else:
             self.sock = None  # the socket used for communication
             self.state = "disconnected"
@@ -37,6 +91,9 @@ class Peer(threading.Thread):
         return new_peer
 
     def connect(self):
+        '''Connect to the remote peer. This blocks, so the overlay leaves it
+        to the thread of the peer, which reports a failure like a closed
+        connection. Messages sent before are queued after our Hello.'''
         if self.address is None:
             raise ValueError('cannot connect to peer without address')
         if self.state != "disconnected":
@@ -47,13 +104,19 @@ class Peer(threading.Thread):
         with self.socket_lock:
             try:
                 self.sock = socket.socket()  # defaults to IPv4 TCP
+                self.sock.settimeout(CONNECT_TIMEOUT)
                 self.sock.connect(self.address)
-                self.send(proto.Hello(get_port()))
+                self.sock.settimeout(None)
             except OSError:
                 self.sock = None
                 self.state = "disconnected"
                 raise
 
+            hello = proto.encode(proto.Hello(get_port()))
+            with self.outbox_changed:
+                self.outbox.insert(0, hello)
+                self.outbox_size += len(hello)
+            self._start_writer()
             self.state = "connected"
 
     def get_state(self):
@@ -68,22 +131,101 @@ class Peer(threading.Thread):
 
     def disconnect(self):
         self.logger.debug('closing connection to peer {}'.format(self))
-        self.sock.shutdown(socket.SHUT_WR)
         self.state = "disconnected"
+        # the writer shuts the socket down after sending what is queued
+        with self.outbox_changed:
+            self.closing = True
+            self.outbox_changed.notify()
 
     def send(self, message):
-        '''Send a protocol message to the remote peer'''
+        '''Queue a protocol message for the remote peer. Frames are sent by
+        the writer thread, together with the other frames queued meanwhile.
+        This never blocks: if too much is queued, bulk frames are dropped,
+        and the message itself if that is not enough.'''
 
-        # TODO handle blocking calls -> may lead to a global deadlock, because
-        # it's the big overlay handler thread that is blocking here!
         self.logger.debug('sending {} -> {}'.format(type(message), self))
-        try:
-            self.sock.send(bytes(message))
-        except OSError as e:
-            # do not propagate this error, the reveiver part will report an
-            # error if the connection was closed (we don't handle half-closed
-            # connctions as we don't "use" them)
-            self.logger.exception(e)
+        frame = proto.encode(message, self.encoding, self.compression)
+        with self.outbox_changed:
+            if self.closing:
+                self.logger.debug('connection is closing, dropping {}'.format(type(message)))
+                return
+            while self.bulk and self.outbox_size + len(frame) > _max_queued:
+                self.outbox_size -= len(self.bulk.popleft())
+                self._dropped()
+            if self.outbox_size + len(frame) > _max_queued:
+                self._dropped()
+                return
+            if isinstance(message, BULK_MESSAGES):
+                self.bulk.append(frame)
+            else:
+                self.outbox.append(frame)
+            self.outbox_size += len(frame)
+            if self.busy_since is None:
+                self.busy_since = time.monotonic()
+            # the writer only waits for the first frame or for a full buffer
+            if len(self.outbox) + len(self.bulk) == 1 or self.outbox_size >= _flush_size:
+                self.outbox_changed.notify()
+
+    def _dropped(self):
+        if not self.dropped:
+            self.logger.warning('peer {} does not keep up, dropping messages'.format(self))
+        self.dropped += 1
+
+    def is_slow(self):
+        '''Return whether the peer has not received all messages queued for
+        it for a while.'''
+        busy_since = self.busy_since
+        return busy_since is not None and time.monotonic() - busy_since > _slow_after
+
+    def get_send_stats(self):
+        return {'queued': self.outbox_size, 'dropped': self.dropped, 'slow': self.is_slow()}
+
+    def _start_writer(self):
+        self.writer = threading.Thread(target=self._write, args=(self.sock,), daemon=True)
+        self.writer.start()
+
+    def _take_frames(self):
+        '''Wait for frames to send, and for more of them as configured.'''
+        with self.outbox_changed:
+            while not self.outbox and not self.bulk and not self.closing:
+                self.busy_since = None
+                self.outbox_changed.wait()
+            deadline = time.monotonic() + _flush_delay
+            while not self.closing and self.outbox_size < _flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.outbox_changed.wait(remaining)
+            frames, self.outbox = self.outbox, []
+            # then some bulk frames, or all of them before shutting down
+            size = 0
+            while self.bulk and (size < BULK_BATCH or self.closing):
+                frames.append(self.bulk.popleft())
+                size += len(frames[-1])
+            self.outbox_size -= sum(len(f) for f in frames)
+            return frames, self.closing
+
+    def _write(self, sock):
+        '''Run by the writer thread, until the connection is shut down.'''
+        while True:
+            frames, closing = self._take_frames()
+            try:
+                if frames:
+                    send_frames(sock, frames)
+                if closing:
+                    sock.shutdown(socket.SHUT_WR)
+                    return
+            except OSError as e:
+                # do not propagate this error, the reveiver part will report an
+                # error if the connection was closed (we don't handle half-closed
+                # connctions as we don't "use" them)
+                with self.outbox_changed:
+                    if not self.closing:
+                        self.logger.exception(e)
+                    self.closing = True
+                    self.outbox, self.outbox_size = [], 0
+                    self.bulk.clear()
+                return
 
     def __str__(self):
         return '{}'.format(self.get_address())
@@ -96,15 +238,28 @@ class Peer(threading.Thread):
         # If so, use selectors and only read (and lock!) when there is
         # something to read.
 
-        msg = None
+        if self.sock is None:
+            try:
+                self.connect()
+            except OSError as e:
+                self.logger.warning('cannot connect to {} ({})'.format(self, e))
+                self.inbox.put(None)
+                return
+
+        reader = proto.FrameReader(self.sock)
         while True:
+            # all messages that arrived together are handled in one go
             try:
-                msg = proto.receive(self.sock)
+                messages = reader.read_all()
             except OSError as e:
-                msg = None
+                messages = []
                 self.logger.warning('error reading from socket: {}'.format(e.strerror))
+            except ValueError as e:
+                # the peer is broken or speaks another protocol
+                messages = []
+                self.logger.warning('invalid message from {} ({})'.format(self, e))
 
-            if msg is None:
+            if not messages:
                 self.logger.info('TCP connection was closed')
 
                 try:
@@ -114,22 +269,42 @@ class Peer(threading.Thread):
                     if e.errno != 107:
                         raise
 
+                with self.outbox_changed:
+                    self.closing = True
+                    self.outbox_changed.notify()
                 self.sock.close()
                 self.inbox.put(None)
                 return
 
-            if isinstance(msg, proto.Hello):
-                # update the remote port
-                ip, port = self.address
-                new_port = msg.get_port()
-                self.logger.debug('remote server port is now known as {} (was: {})'
-                                  .format(new_port, port))
-                self.address = (ip, new_port)
-                continue
+            for msg in messages:
+                if isinstance(msg, proto.Hello):
+                    # update the remote port
+                    ip, port = self.address
+                    new_port = msg.get_port()
+                    self.logger.debug('remote server port is now known as {} (was: {})'
+                                      .format(new_port, port))
+                    self.address = (ip, new_port)
+                    self.encoding = proto.negotiate(getattr(msg, 'codecs', ()))
+                    self.compression = proto.negotiate_compression(getattr(msg, 'compression', ()))
+                    continue
 
-            self.inbox.put(msg)
+                self.inbox.put(msg)
 
-            if msg is None:
-                self.sock.shutdown(socket.SHUT_RDWR)
-                self.sock.close()
-                return
+
+def send_frames(sock, frames):
+    '''Send a list of frames with as few system calls as possible, handling
+    partial writes.'''
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+        return
+    frames = [memoryview(f) for f in frames]
+    first = 0
+    while first < len(frames):
+        sent = sock.sendmsg(frames[first:first + MAX_IOV])
+        while sent > 0:
+            if sent >= len(frames[first]):
+                sent -= len(frames[first])
+                first += 1
+            else:
+                frames[first] = frames[first][sent:]
+                sent = 0
@@ -1,37 +1,164 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from collections import deque
+import io
 import logging
 import pickle
 
-from proto.group import GroupJoin, GroupInfo, GroupMusic, GroupLeave, GroupPing, GroupPong, GroupPlaylist
+from proto.group import GroupJoin, GroupInfo, GroupMusic, GroupMusicAck, GroupLeave, GroupPing, GroupPong, GroupPlaylist
 from proto.peer import Hello, Neighbour, Sample
 from proto.ping import Ping, Pong
+from proto.util import ANNOUNCED_CODECS, CODECS, COMPRESSION
+from proto.codec import CodecError, get_compression_stats, set_compress_threshold
+from proto import codec, legacy
+
+# classes a pickled message may contain, anything else is rejected. Pickled
+# messages are in the format of nodes from before binary frames, see
+# proto.legacy, so none of the newer classes are needed.
+_unpickle_allowed = {
+    ('builtins', 'set'), ('builtins', 'frozenset'), ('builtins', 'list'),
+    ('builtins', 'tuple'), ('builtins', 'dict'), ('builtins', 'bytearray'),
+    ('uuid', 'UUID'), ('copyreg', '_reconstructor'), ('builtins', 'object')
+}
+_unpickle_allowed |= set((cls.__module__, cls.__name__) for (cls, _) in codec.SCHEMAS.values())
+
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) not in _unpickle_allowed:
+            raise pickle.UnpicklingError('forbidden class {}.{}'.format(module, name))
+        return super().find_class(module, name)
+
+
+def _loads(data):
+    return _RestrictedUnpickler(io.BytesIO(data)).load()
+
+
+def encode_frames(message, encoding='pickle', compression=()):
+    '''Return the frames of a message in the given encoding (one of CODECS).
+    Binary frames are compressed with one of the given methods if
+    worthwhile. Pickled frames are meant for nodes from before binary frames,
+    a message may take several of them in their format.'''
+    if encoding == 'binary':
+        return [codec.encode(message, compression)]
+    return [bytes(m) for m in legacy.downgrade(message)]
+
+
+def encode(message, encoding='pickle', compression=()):
+    '''Return a message framed in the given encoding, see encode_frames.'''
+    return b''.join(encode_frames(message, encoding, compression))
+
+
+def negotiate(codecs):
+    '''Choose the encoding for a remote side announcing the given codecs.'''
+    return 'binary' if ANNOUNCED_CODECS[1] in (codecs or ()) else 'pickle'
+
+
+def negotiate_compression(methods):
+    '''Return the compression methods both we and the remote side know.'''
+    return tuple(m for m in COMPRESSION if m in (methods or ()))
 
 
 def parse(rawbytes):
     '''Parse a protocol message from a given bytes object.'''
     try:
-        return pickle.loads(rawbytes)
+        if rawbytes[:1] == bytes([codec.MAGIC]):
+            tag, flags, length = codec.parse_header(rawbytes)
+            payload = rawbytes[codec.HEADER.size:codec.HEADER.size + length]
+            return codec.decode_payload(tag, payload, flags)
+        return legacy.upgrade(_loads(rawbytes))
     except Exception as e:
         logging.getLogger('proto').exception(e)
         return None
 
 
-def receive(sock):
-    b = None
-    length = b''
-    while True:
-        b = sock.recv(1)
-        if not b or not len(b):
-            return None
-        elif b == b'\n':
-            break
-        length += b
-
-    length = int(length.decode())
-    data = b''
-    while length > 0:
-        new = sock.recv(min(4096, length))
-        data += new
-        length -= len(new)
-    return pickle.loads(data)
+class FrameReader(object):
+    '''Reads the messages arriving on a socket. Data is received into a
+    reusable buffer and frames are parsed from it in place, so one system call
+    can yield several messages. Without a socket, received data is passed to
+    feed() instead.'''
+    chunk_size = 65536
+    max_length_digits = 10  # length prefix of a pickled frame
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.pos = 0  # start of the unparsed data in buffer
+        self.chunk = None if sock is None else memoryview(bytearray(FrameReader.chunk_size))
+        self.messages = deque()
+
+    def _fill(self):
+        n = self.sock.recv_into(self.chunk)
+        if n == 0:
+            return False
+        self._append(self.chunk[:n])
+        return True
+
+    def _append(self, data):
+        del self.buffer[:self.pos]
+        self.pos = 0
+        self.buffer += data
+
+    def feed(self, data):
+        '''Add received data and return the messages it completed.'''
+        self._append(data)
+        self._parse()
+        messages = list(self.messages)
+        self.messages.clear()
+        return messages
+
+    def _parse(self):
+        '''Parse the complete frames in the buffer into messages.'''
+        with memoryview(self.buffer) as view:
+            while True:
+                available = len(view) - self.pos
+                if available == 0:
+                    return
+                if view[self.pos] == codec.MAGIC:
+                    if available < codec.HEADER.size:
+                        return
+                    tag, flags, length = codec.parse_header(view[self.pos:])
+                    start = self.pos + codec.HEADER.size
+                    if len(view) - start < length:
+                        return
+                    message = codec.decode_payload(tag, view[start:start + length], flags)
+                else:
+                    newline = self.buffer.find(b'\n', self.pos,
+                                               self.pos + FrameReader.max_length_digits + 1)
+                    if newline < 0:
+                        if available > FrameReader.max_length_digits:
+                            raise ValueError('invalid frame length')
+                        return
+                    length = int(view[self.pos:newline].tobytes())
+                    if length < 0:
+                        raise ValueError('invalid frame length')
+                    start = newline + 1
+                    if len(view) - start < length:
+                        return
+                    try:
+                        message = _loads(view[start:start + length])
+                    except Exception as e:
+                        raise CodecError('cannot unpickle message ({})'.format(e))
+                    message = legacy.upgrade(message)
+                self.pos = start + length
+                self.messages.append(message)
+
+    def read(self):
+        '''Return the next message, or None once the connection is closed.
+        Raises ValueError if the data is not a valid frame.'''
+        while not self.messages:
+            if not self._fill():
+                return None
+            self._parse()
+        return self.messages.popleft()
+
+    def read_all(self):
+        '''Return all messages that have arrived, waiting for at least one.
+        Returns an empty list once the connection is closed.'''
+        message = self.read()
+        if message is None:
+            return []
+        messages = [message] + list(self.messages)
+        self.messages.clear()
+        return messages
+
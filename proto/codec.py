@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Binary encoding of the protocol messages.
+
+A frame is a fixed header followed by the payload:
+
+    magic (1 byte, 0xE2), version (1), type tag (1), flags (1), length (4)
+
+The magic byte can never start a pickled frame (which starts with the
+decimal length), so both kinds of frames can be told apart on one
+connection. The payload is the list of fields of the message type, packed
+with struct in network byte order. Large payloads may be compressed, which
+is marked in the flags. Nodes announce the version they understand with the
+codec, so the version must be raised whenever the fields of a message type
+change.
+'''
+from array import array
+from itertools import accumulate
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+try:
+    import lzma
+    _decompress_errors = (zlib.error, lzma.LZMAError)
+except ImportError:
+    lzma = None
+    _decompress_errors = (zlib.error,)
+
+from bloom_filter import BloomFilter
+from fingerprint_set import FingerprintSet
+from minhash import MinHashSignature
+from proto.group import (GroupJoin, GroupInfo, GroupMusic, GroupMusicAck, GroupLeave,
+                         GroupPing, GroupPong, GroupPlaylist)
+from proto.peer import Hello, Neighbour, Sample
+from proto.ping import Ping, Pong
+from proto.util import BINARY_VERSION
+
+MAGIC = 0xE2
+VERSION = BINARY_VERSION
+HEADER = struct.Struct('!BBBBI')
+
+FLAG_ZLIB = 0x01
+FLAG_LZMA = 0x02
+MAX_PAYLOAD = 64 * 1024 * 1024  # limit for decompressed payloads
+
+_compress_threshold = 1024  # smaller payloads are never compressed
+_bulk_threshold = 65536  # payloads from this size on use lzma, if possible
+_stat_keys = ('frames', 'raw', 'sent', 'compress_time', 'received', 'decompress_time')
+_stats = dict()  # message type name -> dict of counts, see get_compression_stats
+_stats_lock = threading.Lock()
+
+_u8 = struct.Struct('!B')
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('!I')
+_i64 = struct.Struct('!q')
+_u64 = struct.Struct('!Q')
+_bloom_header = struct.Struct('!IBId')
+
+
+class CodecError(ValueError):
+    '''Raised for frames that cannot be decoded.'''
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def unpack(self, s):
+        try:
+            values = s.unpack_from(self.data, self.pos)
+        except struct.error as e:
+            raise CodecError(str(e))
+        self.pos += s.size
+        return values[0] if len(values) == 1 else values
+
+    def take(self, n):
+        if self.pos + n > len(self.data):
+            raise CodecError('truncated payload')
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+
+def _u64_array(values):
+    a = array('Q', values)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _read_u64_array(r, count):
+    a = array('Q')
+    a.frombytes(r.take(8 * count))
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+
+# field types: (encode(value) -> bytes, decode(reader) -> value)
+
+def _enc_bool(v):
+    return _u8.pack(bool(v))
+
+
+def _dec_bool(r):
+    return bool(r.unpack(_u8))
+
+
+def _enc_int(v):
+    return _i64.pack(v)
+
+
+def _dec_int(r):
+    return r.unpack(_i64)
+
+
+def _enc_str(v):
+    data = str(v).encode()
+    return _u32.pack(len(data)) + data
+
+
+def _dec_str(r):
+    return str(r.take(r.unpack(_u32)), 'utf8')
+
+
+def _varints(values):
+    # 7 bits per byte, low bits first, the high bit is set on all bytes but
+    # the last one of a value
+    values = list(values)
+    if not values or max(values) < 0x80:
+        return bytes(values)
+    data = bytearray()
+    for v in values:
+        while v >= 0x80:
+            data.append((v & 0x7f) | 0x80)
+            v >>= 7
+        data.append(v)
+    return bytes(data)
+
+
+def _read_varints(r, count):
+    if r.pos + count <= len(r.data):
+        # values below 128 take one byte each
+        data = r.data[r.pos:r.pos + count]
+        if not count or max(data) < 0x80:
+            r.pos += count
+            return list(data)
+    values = []
+    for _ in range(count):
+        value = shift = 0
+        while True:
+            byte = r.unpack(_u8)
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+            if shift > 28:
+                raise CodecError('varint too long')
+        values.append(value)
+    return values
+
+
+def _enc_strs(v):
+    v = list(v)
+    try:
+        text = '\n'.join(v)
+    except TypeError:
+        v = [str(s) for s in v]
+        text = '\n'.join(v)
+    if text.count('\n') == max(len(v) - 1, 0):
+        # no string contains a newline, they are sent as one text
+        return _u32.pack(len(v)) + b'\0' + _enc_str(text)
+    # all lengths first, then all strings, so they can be split in one go
+    data = [s.encode() for s in v]
+    return _u32.pack(len(v)) + b'\1' + _varints(map(len, data)) + b''.join(data)
+
+
+def _dec_strs(r):
+    count = r.unpack(_u32)
+    layout = r.unpack(_u8)
+    if layout == 0:
+        text = _dec_str(r)
+        strs = text.split('\n') if count or text else []
+        if len(strs) != count:
+            raise CodecError('expected {} strings, got {}'.format(count, len(strs)))
+        return set(strs)
+    elif layout != 1:
+        raise CodecError('unknown string set layout {}'.format(layout))
+    lengths = _read_varints(r, count)
+    blob = r.take(sum(lengths))
+    ends = list(accumulate(lengths))
+    text = str(blob, 'utf8')
+    if len(text) == len(blob):
+        # ascii only, byte offsets are character offsets
+        return {text[start:end] for (start, end) in zip([0] + ends, ends)}
+    blob = bytes(blob)
+    return {str(blob[start:end], 'utf8') for (start, end) in zip([0] + ends, ends)}
+
+
+def _optional(enc, dec):
+    def encode(v):
+        return b'\0' if v is None else b'\1' + enc(v)
+
+    def decode(r):
+        return dec(r) if r.unpack(_u8) else None
+    return encode, decode
+
+
+def _enc_id(v):
+    if isinstance(v, uuid.UUID):
+        return b'\1' + v.bytes
+    return b'\0' + _enc_str(v)
+
+
+def _dec_id(r):
+    if r.unpack(_u8):
+        return uuid.UUID(bytes=bytes(r.take(16)))
+    return _dec_str(r)
+
+
+def _enc_fingerprints(v):
+    return _u32.pack(len(v)) + _u64_array(v.array)
+
+
+def _dec_fingerprints(r):
+    result = FingerprintSet()
+    result.array = _read_u64_array(r, r.unpack(_u32))
+    return result
+
+
+def _enc_bloom(v):
+    return (_bloom_header.pack(v.size, v.hashes, v.count, v.error_rate) +
+            _u32.pack(len(v.bits)) + bytes(v.bits))
+
+
+def _dec_bloom(r):
+    bloom = BloomFilter.__new__(BloomFilter)
+    bloom.size, bloom.hashes, bloom.count, bloom.error_rate = r.unpack(_bloom_header)
+    bloom.bits = bytearray(r.take(r.unpack(_u32)))
+    try:
+        bloom.check()
+    except ValueError as e:
+        raise CodecError('invalid bloom filter ({})'.format(e))
+    return bloom
+
+
+def _enc_signature(v):
+    return _u16.pack(v.size) + _u32.pack(len(v.values)) + _u64_array(v.values)
+
+
+def _dec_signature(r):
+    signature = MinHashSignature.__new__(MinHashSignature)
+    signature.size = r.unpack(_u16)
+    signature.values = list(_read_u64_array(r, r.unpack(_u32)))
+    return signature
+
+
+# songs: a set of fingerprints or a summary of it
+_SONGS = [(type(None), lambda v: b'', lambda r: None),
+          (FingerprintSet, _enc_fingerprints, _dec_fingerprints),
+          (BloomFilter, _enc_bloom, _dec_bloom)]
+
+
+def _enc_songs(v):
+    for tag, (cls, enc, _) in enumerate(_SONGS):
+        if isinstance(v, cls):
+            return _u8.pack(tag) + enc(v)
+    # e.g. a plain set of fingerprints
+    return _enc_songs(FingerprintSet(v))
+
+
+def _dec_songs(r):
+    tag = r.unpack(_u8)
+    if tag >= len(_SONGS):
+        raise CodecError('unknown songs tag {}'.format(tag))
+    return _SONGS[tag][2](r)
+
+
+def _enc_value(v):
+    '''Encode the argument of a playlist operation.'''
+    if v is None:
+        return b'\0'
+    elif isinstance(v, int):
+        return b'\1' + _u64.pack(v) if v >= 0 else b'\2' + _i64.pack(v)
+    elif isinstance(v, (list, tuple)):
+        return b'\3' + _u32.pack(len(v)) + _u64_array(v)
+    return b'\4' + _enc_str(v)
+
+
+def _dec_value(r):
+    tag = r.unpack(_u8)
+    if tag == 0:
+        return None
+    elif tag == 1:
+        return r.unpack(_u64)
+    elif tag == 2:
+        return r.unpack(_i64)
+    elif tag == 3:
+        return list(_read_u64_array(r, r.unpack(_u32)))
+    elif tag == 4:
+        return _dec_str(r)
+    raise CodecError('unknown value tag {}'.format(tag))
+
+
+BOOL = (_enc_bool, _dec_bool)
+INT = (_enc_int, _dec_int)
+OPT_INT = _optional(_enc_int, _dec_int)
+STR = (_enc_str, _dec_str)
+STRS = (_enc_strs, _dec_strs)
+ID = (_enc_id, _dec_id)
+SONGS = (_enc_songs, _dec_songs)
+OPT_SIGNATURE = _optional(_enc_signature, _dec_signature)
+VALUE = (_enc_value, _dec_value)
+
+# type tag -> (message class, [(attribute, field type)]); tags must never be
+# reused for a different message
+SCHEMAS = {
+    1: (Hello, [('port', STR), ('codecs', STRS), ('compression', STRS)]),
+    2: (Neighbour, [('force', BOOL)]),
+    3: (Sample, [('hashes', SONGS), ('signature', OPT_SIGNATURE)]),
+    4: (Ping, [('ping_id', ID), ('ttl', INT)]),
+    5: (Pong, [('ping_id', ID), ('addrs', STRS)]),
+    16: (GroupJoin, [('port', STR), ('codecs', STRS)]),
+    17: (GroupInfo, [('leader', STR), ('peers', STRS), ('codecs', STRS)]),
+    18: (GroupMusic, [('hashes', SONGS), ('version', OPT_INT), ('base', OPT_INT),
+                      ('removed', SONGS)]),
+    19: (GroupMusicAck, [('port', STR), ('version', INT)]),
+    20: (GroupLeave, [('port', STR)]),
+    21: (GroupPing, [('ping_id', ID), ('ttl', INT)]),
+    22: (GroupPong, [('ping_id', ID), ('leader', STR), ('music', SONGS),
+                     ('signature', OPT_SIGNATURE)]),
+    23: (GroupPlaylist, [('op', STR), ('arg', VALUE)]),
+}
+_tags = dict((cls, tag) for (tag, (cls, _)) in SCHEMAS.items())
+
+
+def set_compress_threshold(threshold, bulk_threshold=None):
+    '''Set the payload size from which messages are compressed, and from
+    which lzma is used instead of zlib.'''
+    global _compress_threshold, _bulk_threshold
+    _compress_threshold = threshold
+    if bulk_threshold is not None:
+        _bulk_threshold = bulk_threshold
+
+
+def _record(tag, **counts):
+    name = SCHEMAS[tag][0].__name__
+    with _stats_lock:
+        stats = _stats.setdefault(name, dict.fromkeys(_stat_keys, 0))
+        for key, count in counts.items():
+            stats[key] += count
+
+
+def get_compression_stats():
+    '''Return a dict mapping message type names to their compression
+    statistics: the number of frames we tried to compress, their raw and sent
+    bytes and the compression ratio, the time spent compressing, and the
+    number of compressed frames received and the time spent decompressing.'''
+    with _stats_lock:
+        result = dict((name, dict(stats)) for (name, stats) in _stats.items())
+    for stats in result.values():
+        stats['ratio'] = stats['sent'] / stats['raw'] if stats['raw'] else None
+    return result
+
+
+def compress(tag, payload, methods):
+    '''Compress a payload with one of the given methods if it is large enough
+    and gets smaller. Returns the flags and the payload to send.'''
+    if len(payload) < _compress_threshold:
+        return 0, payload
+    if lzma is not None and 'lzma' in methods and len(payload) >= _bulk_threshold:
+        flags, method = FLAG_LZMA, lzma.compress
+    elif 'zlib' in methods:
+        flags, method = FLAG_ZLIB, zlib.compress
+    else:
+        return 0, payload
+    start = time.perf_counter()
+    compressed = method(payload)
+    elapsed = time.perf_counter() - start
+    if len(compressed) >= len(payload):
+        # e.g. random fingerprints, send them as they are
+        _record(tag, frames=1, raw=len(payload), sent=len(payload), compress_time=elapsed)
+        return 0, payload
+    _record(tag, frames=1, raw=len(payload), sent=len(compressed), compress_time=elapsed)
+    return flags, compressed
+
+
+def decompress(tag, flags, payload):
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif flags & FLAG_LZMA:
+        if lzma is None:
+            raise CodecError('lzma is not available')
+        decompressor = lzma.LZMADecompressor()
+    else:
+        return payload
+    start = time.perf_counter()
+    try:
+        data = decompressor.decompress(payload, MAX_PAYLOAD)
+    except _decompress_errors as e:
+        raise CodecError('cannot decompress payload ({})'.format(e))
+    if not decompressor.eof:
+        raise CodecError('payload too large or incomplete')
+    _record(tag, received=1, decompress_time=time.perf_counter() - start)
+    return data
+
+
+def encode_payload(message):
+    '''Return the type tag and the encoded fields of a message.'''
+    tag = _tags[type(message)]
+    fields = SCHEMAS[tag][1]
+    return tag, b''.join(enc(getattr(message, name, None)) for (name, (enc, _)) in fields)
+
+
+def encode(message, compression=()):
+    '''Return a complete binary frame for a message, compressed with one of
+    the given methods if worthwhile.'''
+    tag, payload = encode_payload(message)
+    flags, payload = compress(tag, payload, compression)
+    return HEADER.pack(MAGIC, VERSION, tag, flags, len(payload)) + payload
+
+
+def parse_header(data):
+    '''Parse a frame header, returning (type tag, flags, payload length).'''
+    magic, version, tag, flags, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise CodecError('not a binary frame')
+    if version != VERSION:
+        raise CodecError('unsupported version {}'.format(version))
+    return tag, flags, length
+
+
+def decode_payload(tag, payload, flags=0):
+    try:
+        cls, fields = SCHEMAS[tag]
+    except KeyError:
+        raise CodecError('unknown message type {}'.format(tag))
+    r = _Reader(decompress(tag, flags, payload))
+    message = cls.__new__(cls)
+    for name, (_, dec) in fields:
+        setattr(message, name, dec(r))
+    if r.pos != len(r.data):
+        raise CodecError('trailing data in {}'.format(cls.__name__))
+    return message
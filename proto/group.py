@@ -1,25 +1,50 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from proto.util import PicklingMessage
+from proto.util import ANNOUNCED_CODECS, PicklingMessage
 import network
 import mpd.playback
 import mpd.playlist
 
 
 class GroupJoin(PicklingMessage):
-    def __init__(self, port):
+    def __init__(self, port, codecs=ANNOUNCED_CODECS):
         self.port = port
+        self.codecs = codecs
 
 
 class GroupInfo(PicklingMessage):
-    def __init__(self, leader, peers):
+    def __init__(self, leader, peers, codecs=ANNOUNCED_CODECS):
         self.leader = leader
         self.peers = peers
+        self.codecs = codecs
 
 
 class GroupMusic(PicklingMessage):
-    def __init__(self, hashes):
+    '''The music of a group member, or the group music as of some version.
+    Instead of the full music, the leader can send the songs removed since
+    an older version (the base) the peer already has.'''
+    def __init__(self, hashes, version=None):
         self.hashes = hashes
+        self.version = version
+        self.base = None
+        self.removed = None
+
+    @staticmethod
+    def delta(base, version, removed):
+        msg = GroupMusic(None, version)
+        msg.base = base
+        msg.removed = removed
+        return msg
+
+    def is_delta(self):
+        return getattr(self, 'removed', None) is not None
+
+
+class GroupMusicAck(PicklingMessage):
+    '''Tell the leader which version of the group music a peer has.'''
+    def __init__(self, version):
+        self.port = network.get_group_port()
+        self.version = version
 
 
 class GroupLeave(PicklingMessage):
@@ -34,14 +59,16 @@ class GroupPing(PicklingMessage):
 
 
 class GroupPong(PicklingMessage):
-    def __init__(self, ping_id, leader, music):
+    def __init__(self, ping_id, leader, music, signature=None):
         self.ping_id = ping_id
         self.leader = leader
         self.music = music
+        self.signature = signature
 
 
 class GroupPlaylist(PicklingMessage):
     _add = '+'
+    _add_many = '*'
     _play = '!'
 
     def __init__(self, op, arg):
@@ -56,8 +83,14 @@ class GroupPlaylist(PicklingMessage):
     def add(song):
         return GroupPlaylist(GroupPlaylist._add, song)
 
+    @staticmethod
+    def add_many(songs):
+        return GroupPlaylist(GroupPlaylist._add_many, list(songs))
+
     def do(self):
         if self.op == GroupPlaylist._add:
             mpd.playlist.add(mpd.music.get_song(self.arg))
+        elif self.op == GroupPlaylist._add_many:
+            mpd.playlist.add_many([mpd.music.get_song(h) for h in self.arg])
         elif self.op == GroupPlaylist._play:
             mpd.playback.play(self.arg)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Messages for nodes from before binary frames.
+
+These nodes only understand pickled frames, identify songs by the md5 hex
+digest of the song and know none of the newer classes (fingerprint sets,
+Bloom filters, MinHash signatures). Messages pickled for them carry the
+song hashes in their format, and messages they do not know are sent as
+ones they do. The song hashes of pickled messages we receive are converted
+to fingerprints.
+'''
+from fingerprint_set import FingerprintSet, from_hex
+from proto.codec import CodecError
+from proto.group import GroupMusic, GroupPlaylist, GroupPong
+from proto.peer import Sample
+import mpd.music
+
+_legacy_hashes = mpd.music.get_legacy_hashes
+
+
+def set_legacy_hashes(function):
+    '''Set the function returning the md5 hex digests of the songs with the
+    given fingerprints, by default the ones of our library.'''
+    global _legacy_hashes
+    _legacy_hashes = function
+
+
+def downgrade(message):
+    '''Return the list of messages to pickle for a node from before binary
+    frames in place of the given one.'''
+    if isinstance(message, Sample):
+        return [Sample(set(_legacy_hashes(message.hashes)))]
+    elif isinstance(message, GroupPong):
+        return [GroupPong(message.ping_id, message.leader,
+                          set(_legacy_hashes(message.music)))]
+    elif isinstance(message, GroupMusic):
+        return [GroupMusic(set(_legacy_hashes(message.hashes)))]
+    elif isinstance(message, GroupPlaylist) and message.op == GroupPlaylist._add:
+        return [GroupPlaylist.add(h) for h in _legacy_hashes([message.arg])]
+    elif isinstance(message, GroupPlaylist) and message.op == GroupPlaylist._add_many:
+        # one by one, the batch operation is unknown to these nodes
+        return [GroupPlaylist.add(h) for h in _legacy_hashes(message.arg)]
+    return [message]
+
+
+def _fingerprints(hashes):
+    return FingerprintSet(from_hex(h) for h in hashes)
+
+
+def _upgrade(message):
+    if isinstance(message, Sample):
+        message.hashes = _fingerprints(message.hashes)
+    elif isinstance(message, GroupPong):
+        message.music = _fingerprints(message.music)
+    elif isinstance(message, GroupMusic):
+        message.hashes = _fingerprints(message.hashes)
+    elif isinstance(message, GroupPlaylist) and message.op == GroupPlaylist._add:
+        message.arg = from_hex(message.arg)
+
+
+def upgrade(message):
+    '''Replace the md5 hex digests in a pickled message by fingerprints.
+    Raises CodecError if they are not song hashes.'''
+    try:
+        _upgrade(message)
+    except (AttributeError, TypeError, ValueError, OverflowError) as e:
+        raise CodecError('invalid song hashes in {} ({})'
+                         .format(type(message).__name__, e))
+    return message
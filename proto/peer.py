@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from proto.util import PicklingMessage
+from proto.util import ANNOUNCED_CODECS, COMPRESSION, PicklingMessage
 
 
 class Hello(PicklingMessage):
-    def __init__(self, port):
+    def __init__(self, port, codecs=ANNOUNCED_CODECS, compression=COMPRESSION):
         self.port = port
+        self.codecs = codecs
+        self.compression = compression
 
     def get_port(self):
         return self.port
@@ -18,5 +20,6 @@ class Neighbour(PicklingMessage):
 
 
 class Sample(PicklingMessage):
-    def __init__(self, hashes):
+    def __init__(self, hashes, signature=None):
         self.hashes = hashes
+        self.signature = signature
@@ -1,6 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import pickle
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# encodings of messages this node understands
+CODECS = ('pickle', 'binary')
+# version of the binary frames, raised whenever the layout of a message changes
+BINARY_VERSION = 2
+# codecs announced in Hello, GroupJoin and GroupInfo, binary frames are only
+# used between nodes of the same version
+ANNOUNCED_CODECS = ('pickle', 'binary{}'.format(BINARY_VERSION))
+# compression methods for binary messages this node understands
+COMPRESSION = ('zlib', 'lzma') if lzma is not None else ('zlib',)
 
 
 class PicklingMessage(object):
@@ -1,65 +1,92 @@
 #!/usr/bin/python3
 
+from collections import deque
 import queue
 import threading
 import time
 
-class SignalQueue(queue.Queue):
-    '''A thread-safe queue that triggers a given event whenever new data is
-    inserted.'''
+# priorities of sources, events of higher priority are returned first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
 
-    def __init__(self, events, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.events = events
 
-    def put(self, *args, **kwargs):
-        super().put(*args, **kwargs)
-        self.events.put(self)
+class Source:
+    '''A Queue-like object whose data is delivered by the QueueSet it was
+    created by. Only put() is supported.'''
+
+    __slots__ = ('queue_set', 'priority')
+
+    def __init__(self, queue_set, priority):
+        self.queue_set = queue_set
+        self.priority = priority
+
+    def put(self, item, block=True, timeout=None):
+        self.queue_set._put(self, item)
 
 
 class QueueSet:
-    '''A set of queues that can be waited for simultaneously.'''
-    
-    def __init__(self):
-        self.events = queue.Queue()
-        self.queues = [ ]
+    '''A set of queues that can be waited for simultaneously. All data put
+    into them is kept in one queue per priority, together with the queue it
+    was put into.'''
+
+    def __init__(self, priorities=2):
+        self.not_empty = threading.Condition(threading.Lock())
+        self.events = [deque() for _ in range(priorities)]
+        self.queues = set()
 
-    def New(self):
+    def New(self, priority=PRIORITY_NORMAL):
         '''Create a new Queue-like object that can be waited for by this set'''
 
-        new_queue = SignalQueue(self.events)
-        self.queues.append(new_queue)
+        new_queue = Source(self, priority)
+        with self.not_empty:
+            self.queues.add(new_queue)
 
         return new_queue
 
     def remove(self, q):
-        '''Remove a queue from this set.'''
+        '''Remove a queue from this set. Data put into it is discarded from
+        now on.'''
 
-        if not q in self.queues:
-            raise KeyError()
+        with self.not_empty:
+            self.queues.remove(q)
 
-        self.queues = [ x for x in self.queues if x != q ]
+    def _put(self, q, item):
+        with self.not_empty:
+            if q in self.queues:
+                self.events[q.priority].append((q, item))
+                self.not_empty.notify()
 
     def get(self, timeout=None):
         '''Get the next available input as a (queue,data) pair, blocking if
         necessary. If no data was received within the optionally given timeout,
         an exception of type queue.Empty is raised.'''
-        
-        while True:
-            start_wait = time.monotonic()
-            from_queue = self.events.get(timeout=timeout)
-
-            if from_queue not in self.queues:
-                # wait for next queue entry, because this queue has been
-                # removed in the meantime
-                
-                timeout = time.monotonic() - start_wait
-
-                if timeout <= 0.0:
-                    raise queue.Empty()
-
-                continue
-            
-            else:
-                return (from_queue, from_queue.get())
 
+        return self.get_many(1, timeout)[0]
+
+    def get_many(self, max_items=None, timeout=None):
+        '''Get a list of up to max_items (queue,data) pairs that are
+        available, or all of them, blocking until there is at least one. If
+        none was received within the optionally given timeout, an exception
+        of type queue.Empty is raised.'''
+
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self.not_empty:
+            while True:
+                items = []
+                for events in self.events:
+                    while events and (max_items is None or len(items) < max_items):
+                        (q, item) = events.popleft()
+                        # skip data of queues removed in the meantime
+                        if q in self.queues:
+                            items.append((q, item))
+                if items:
+                    return items
+
+                if timeout is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty()
+                    self.not_empty.wait(remaining)